@@ -22,6 +22,7 @@
 # Imports
 from datetime import date, timedelta
 from globeqa import tools, plotters
+from globeqa.observation import used_keys
 
 # Define the GLOBE Observer protocols you want the data for
 protocols = ["sky_conditions", "land_covers", "mosquito_habitat_mapper", "tree_heights"]
@@ -33,40 +34,48 @@ enddate   = date(2019,12,1)   # end   of date range, format is YYYY,MM,DD
 # Download GLOBE observations from API for given protocol(s) and date range
 path = tools.download_from_api(protocols, startdate, enddate)
 
-# Parse the downloaded file
-rawobs = tools.parse_json(path)
+# Parse the downloaded file, keeping only the properties that the figures and
+# quality checks read (protocol, data source, date & time, location, user,
+# photo URLs, cloud types, land cover class, mosquito genus, etc.)
+#   Tip: To keep every property, e.g. to inspect observations in full, remove
+#        the 'fields' argument.
+rawobs = tools.parse_json(path, fields=used_keys)
+
+# Group the observations by protocol and data source in a single pass.  Each
+# of the subsets below is picked from these groups rather than by scanning
+# every observation again.
+#   Tip: To pick out another subset, e.g. GLOBE Observer tree heights, type
+#        the following in the iPython console:
+#   > groups.select(protocol="tree_heights", DataSource=go_app)
+groups = tools.partition(rawobs, keys=("protocol", "DataSource"))
+go_app = "GLOBE Observer App"
 
 # Filter for only observations made with the GLOBE Observer app
 #   Tip: To display the contents of a single observation, type the following in
 #        the iPython console: 
 #   > tools.pretty_print_observation(obs[0])
-obs = [ob for ob in rawobs if ob["DataSource"] == "GLOBE Observer App"]
+obs = groups.select(DataSource=go_app)
 
 # Filter for only GLOBE observations (i.e., not the app)
-globeobs = [ob for ob in rawobs if ob["DataSource"] != "GLOBE Observer App"]
+globeobs = groups.select(DataSource=lambda source: source != go_app)
 
 # Filter for cloud and land cover observations from the GLOBE Observer app
 # - for Figure 5
-obs5 = [ob for ob in rawobs if (ob["protocol"] in ["land_covers","sky_conditions"] and \
-                             ob["DataSource"] == "GLOBE Observer App")]
+obs5 = groups.select(protocol=["land_covers","sky_conditions"], DataSource=go_app)
 
 # Filter for all (GO + GLOBE) cloud observations
 # - for Colon-Robles et al. 2020, BAMS
-all_cld_obs = [ob for ob in rawobs if (ob["protocol"] in ["sky_conditions"])]
+all_cld_obs = groups.select(protocol="sky_conditions")
 
 
 # Filter for GLOBE Observer observations by protocol
 # - for photo stats for the paper
-go_cld_obs = [ob for ob in rawobs if (ob["protocol"] in ["sky_conditions"] and \
-                             ob["DataSource"] == "GLOBE Observer App")]
+go_cld_obs = groups.select(protocol="sky_conditions", DataSource=go_app)
 
-go_mhm_obs = [ob for ob in rawobs if (ob["protocol"] in ["mosquito_habitat_mapper"] and \
-                             ob["DataSource"] == "GLOBE Observer App")]
+go_mhm_obs = groups.select(protocol="mosquito_habitat_mapper", DataSource=go_app)
 
-go_lc_obs = [ob for ob in rawobs if (ob["protocol"] in ["land_covers"] and \
-                             ob["DataSource"] == "GLOBE Observer App")]
+go_lc_obs = groups.select(protocol="land_covers", DataSource=go_app)
 
-go_th_obs = [ob for ob in rawobs if (ob["protocol"] in ["tree_heights"] and \
-                             ob["DataSource"] == "GLOBE Observer App")]
+go_th_obs = groups.select(protocol="tree_heights", DataSource=go_app)
 
     
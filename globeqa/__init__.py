@@ -2,8 +2,14 @@
     Tools for GLOBE data quality assurance.
 """
 
+from . import landmask
+from . import npzfile
 from . import observation
+from . import partition
 from . import plotters
+from . import spatialindex
+from . import table
+from . import timeindex
 from . import tools
 
 name = "globeqa"
\ No newline at end of file
@@ -0,0 +1,190 @@
+#------------------------------------------------------------------------------
+# LANDMASK.PY
+#
+# PURPOSE
+# Set up the LandMask class, which answers whether points are over land by
+# looking them up in a precomputed land/water/coastal raster, and only tests
+# the points near a coastline against the land geometry itself.
+#
+# RESOURCES
+# - GLOBE Observer website: observer.globe.gov
+# - GLOBE Data User Guide: https://www.globe.gov/globe-data/globe-data-user-guide
+# - Download the GLOBE Observer app: https://observer.globe.gov/about/get-the-app
+# - Natural Earth land polygons: https://www.naturalearthdata.com/
+#
+# CITATION
+# Amos, H.M. and M.J. Starke et al., 2020, GLOBE Observer
+# Data:2016-2019, in prep. *Check back for updated journal
+# information and publication DOI*
+#
+# CORRESPONDING AUTHOR
+# Helen Amos, helen.m.amos@nasa.gov
+#
+# DISCLAIMER
+# This code comes as is without guarantees of any kind.
+#------------------------------------------------------------------------------
+
+import cartopy
+import hashlib
+from globeqa.npzfile import savez_atomic
+import numpy as np
+from os.path import isfile, join
+import shapely.geometry as sgeom
+from shapely.prepared import PreparedGeometry, prep
+from typing import Iterable, Optional
+try:
+    from shapely import contains_xy
+except ImportError:
+    # Shapely 1.x provides the same vectorized predicate under a different name.
+    from shapely.vectorized import contains as contains_xy
+
+
+# The values of the cells of a LandMask.
+WATER = 0
+LAND = 1
+COASTAL = 2
+
+# Bump this whenever the way cells are classified changes, so that old rasters on disk are rebuilt.
+_land_mask_version = 1
+
+# Each cell is classified by a box this much (in degrees) larger than the cell on every side, so that a point which
+# rounding places in a neighboring cell is still covered by the classification of the cell it is looked up in.
+_cell_margin = 1e-9
+
+# Cells are classified in square blocks of up to this many cells on a side, which are split into quarters only when
+# they are neither entirely over land nor entirely over water.
+_largest_block = 32
+
+
+class LandMask:
+    def __init__(self, land, cell_size: float = 0.5, cache_dir: Optional[str] = None):
+        """
+        A LandMask determines whether points are over land, with exactly the same result as
+        land.contains(Point(lon, lat)), but mostly by array lookup.  The globe is divided into cells of cell_size
+        degrees, each classified once as WATER, LAND, or COASTAL (neither entirely over land nor entirely over water);
+        only points in COASTAL cells are tested against the geometry.  The raster of cells is saved in cache_dir and
+        reused by later LandMasks with the same geometry and cell size.  A LandMask can be used wherever a
+        PreparedGeometry is accepted for land checking.
+        :param land: The PreparedGeometry (see tools.prepare_earth_geometry()), or an unprepared geometry.
+        :param cell_size: The size of each cell, in degrees of latitude and longitude.  Default 0.5.
+        :param cache_dir: The folder in which rasters are kept.  Default None, which uses cartopy's data folder (where
+        the NaturalEarth files are also kept).
+        :raises ValueError: If cell_size is not positive.
+        """
+        if not cell_size > 0:
+            raise ValueError("Argument 'cell_size' must be positive.")
+
+        self.land = land if isinstance(land, PreparedGeometry) else prep(land)
+        self.geometry = self.land.context
+        self.cell_size = float(cell_size)
+        self.cache_dir = cartopy.config["data_dir"] if cache_dir is None else cache_dir
+        self.geometry_sha256 = hashlib.sha256(self.geometry.wkb).hexdigest()
+
+        self.cells = self._load()
+        if self.cells is None:
+            self.cells = self._build()
+            self._save()
+
+    @property
+    def cache_path(self) -> str:
+        """
+        :return: The path of the raster for this geometry and cell size.
+        """
+        return join(self.cache_dir, "land_mask_{}_{}.npz".format(self.cell_size, self.geometry_sha256[:16]))
+
+    def _load(self) -> Optional[np.ndarray]:
+        """
+        :return: The raster saved on disk, or None if there is none, or if it is for a different geometry or was written
+        by an incompatible version of this code.
+        """
+        if not isfile(self.cache_path):
+            return None
+
+        with np.load(self.cache_path) as cache:
+            if (int(cache["_version"]) != _land_mask_version or float(cache["_cell_size"]) != self.cell_size or
+                    str(cache["_geometry_sha256"]) != self.geometry_sha256):
+                return None
+            return cache["cells"]
+
+    def _save(self):
+        """
+        Saves the raster to disk.
+        """
+        savez_atomic(self.cache_path, compressed=True, _version=np.array(_land_mask_version),
+                     _cell_size=np.array(self.cell_size), _geometry_sha256=np.array(self.geometry_sha256),
+                     cells=self.cells)
+
+    def _build(self) -> np.ndarray:
+        """
+        Classifies every cell.
+        :return: The raster, with one row per band of latitude (from the south) and one column per band of longitude
+        (from the west).
+        """
+        print("--  Building land mask...")
+        rows = int(np.ceil(180. / self.cell_size))
+        cols = int(np.ceil(360. / self.cell_size))
+        cells = np.full((rows, cols), COASTAL, dtype=np.uint8)
+
+        pending = [(row, col, _largest_block) for row in range(0, rows, _largest_block)
+                   for col in range(0, cols, _largest_block)]
+        while len(pending) > 0:
+            row, col, size = pending.pop()
+            row_end, col_end = min(row + size, rows), min(col + size, cols)
+            box = sgeom.box(-180. + col * self.cell_size - _cell_margin, -90. + row * self.cell_size - _cell_margin,
+                            -180. + col_end * self.cell_size + _cell_margin,
+                            -90. + row_end * self.cell_size + _cell_margin)
+
+            # A point is only contained by the land if it is in its interior, so a block that touches the land at all
+            # is not WATER, and a block must be in the interior of the land to be LAND.
+            if not self.land.intersects(box):
+                cells[row:row_end, col:col_end] = WATER
+            elif self.land.contains_properly(box):
+                cells[row:row_end, col:col_end] = LAND
+            elif size > 1:
+                half = size // 2
+                pending += [(r, c, half) for r in (row, row + half) for c in (col, col + half)
+                            if r < row_end and c < col_end]
+
+        print("--  Land mask built.")
+        return cells
+
+    def cell_types(self, lon: Iterable[float], lat: Iterable[float]) -> np.ndarray:
+        """
+        Looks up the cells that points are in.
+        :param lon: The longitude of each point.
+        :param lat: The latitude of each point.
+        :return: The classification (WATER, LAND or COASTAL) of the cell of each point.  Points outside the raster or
+        with a NaN coordinate are COASTAL, so that they are always tested against the geometry.
+        """
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        rows = np.floor((lat + 90.) / self.cell_size)
+        cols = np.floor((lon + 180.) / self.cell_size)
+        inside = (rows >= 0) & (rows < self.cells.shape[0]) & (cols >= 0) & (cols < self.cells.shape[1])
+
+        ret = np.full(lon.shape, COASTAL, dtype=np.uint8)
+        ret[inside] = self.cells[rows[inside].astype(np.intp), cols[inside].astype(np.intp)]
+        return ret
+
+    def contains_xy(self, lon: Iterable[float], lat: Iterable[float]) -> np.ndarray:
+        """
+        Determines whether many points are over land at once.
+        :param lon: The longitude of each point.
+        :param lat: The latitude of each point.
+        :return: A boolean array of whether each point is over land.
+        """
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        types = self.cell_types(lon, lat)
+        ret = types == LAND
+        coastal = types == COASTAL
+        ret[coastal] = contains_xy(self.geometry, lon[coastal], lat[coastal])
+        return ret
+
+    def contains(self, point: sgeom.Point) -> bool:
+        """
+        :param point: The point.
+        :return: Whether the point is over land.  This lets a LandMask stand in for a PreparedGeometry, e.g. in
+        Observation.check_for_flags().
+        """
+        return bool(self.contains_xy([point.x], [point.y])[0])
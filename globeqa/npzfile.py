@@ -0,0 +1,46 @@
+#------------------------------------------------------------------------------
+# NPZFILE.PY
+#
+# PURPOSE
+# Save the NumPy archives that this package keeps on disk (column caches,
+# land masks, earth geometry and quality check results) so that a save that
+# is interrupted never leaves a corrupt archive behind.
+#
+# RESOURCES
+# - GLOBE Observer website: observer.globe.gov
+# - GLOBE Data User Guide: https://www.globe.gov/globe-data/globe-data-user-guide
+# - Download the GLOBE Observer app: https://observer.globe.gov/about/get-the-app
+#
+# CITATION
+# Amos, H.M. and M.J. Starke et al., 2020, GLOBE Observer
+# Data:2016-2019, in prep. *Check back for updated journal
+# information and publication DOI*
+#
+# CORRESPONDING AUTHOR
+# Helen Amos, helen.m.amos@nasa.gov
+#
+# DISCLAIMER
+# This code comes as is without guarantees of any kind.
+#------------------------------------------------------------------------------
+
+import numpy as np
+from os import makedirs, replace
+from os.path import dirname
+
+
+def savez_atomic(fp: str, compressed: bool = False, **arrays):
+    """
+    Saves arrays to an .npz file.  They are written to a temporary file next to fp first, which then replaces fp, so
+    fp only ever holds a complete archive.  The folder of fp is created if needed.
+    :param fp: The path to save to.
+    :param compressed: Whether to compress the arrays (see np.savez_compressed()).  Default False.
+    :param arrays: The arrays to save, by name.
+    """
+    if dirname(fp) != "":
+        makedirs(dirname(fp), exist_ok=True)
+    part_fp = fp + ".part.npz"
+    if compressed:
+        np.savez_compressed(part_fp, **arrays)
+    else:
+        np.savez(part_fp, **arrays)
+    replace(part_fp, fp)
@@ -26,8 +26,11 @@
 #------------------------------------------------------------------------------
 
 from datetime import datetime
+from functools import wraps
+import json
 import shapely.geometry as sgeom
-from typing import Optional, List, Union, Dict
+import sys
+from typing import Optional, List, Union, Dict, Tuple, Iterable
 
 
 class CloudCover:
@@ -138,7 +141,110 @@ class CloudCover:
             raise ValueError("'{}' does not represent a valid cloud cover category.".format(cat))
 
 
+def memoized_property(func):
+    """
+    Turns a method of Observation into a property whose value is computed once and then remembered until the
+    observation's properties change (see Observation.invalidate_cache()).  Any flags raised while computing the value
+    are remembered with it and raised again on every later access, so caching does not change which flags are raised.
+    :param func: The method that computes the value.
+    :return: The property.
+    """
+    name = func.__name__
+
+    @wraps(func)
+    def getter(self):
+        if self._memo is None:
+            self._memo = dict()
+        try:
+            val, raised = self._memo[name]
+        except KeyError:
+            # Swap in an empty flag list to capture exactly the flags raised during the computation.
+            flags = self.flags
+            self.flags = []
+            try:
+                val = func(self)
+            finally:
+                raised = tuple(self.flags)
+                self.flags = flags
+            self._memo[name] = (val, raised)
+        for flag in raised:
+            self.flag(flag)
+        return val
+
+    return property(getter)
+
+
+# Assigns each flag its own bit, so that a set of flags can be represented as one integer.  The flags defined in
+# Observation._flag_definitions take the lowest bits, in order of definition; any other flag is given the next free bit
+# the first time it is seen.
+flag_bits = dict()
+
+
+def flag_bit(flag: str) -> int:
+    """
+    :param flag: The code for the flag.
+    :return: The bit representing the flag.
+    :raises ValueError: If more than 64 distinct flags are used, as they would no longer fit in a 64-bit integer.
+    """
+    try:
+        return flag_bits[flag]
+    except KeyError:
+        if len(flag_bits) >= 64:
+            raise ValueError("No more than 64 distinct flags can be represented.")
+        bit = flag_bits[flag] = 1 << len(flag_bits)
+        return bit
+
+
+def flags_to_mask(flags: Iterable[str]) -> int:
+    """
+    :param flags: The codes for the flags.
+    :return: The integer with the bit for each flag set.
+    """
+    mask = 0
+    for flag in flags:
+        mask |= flag_bit(flag)
+    return mask
+
+
+def mask_to_flags(mask: int) -> List[str]:
+    """
+    :param mask: An integer with one bit set per flag.
+    :return: The codes for the flags, in bit order.
+    """
+    return [flag for flag, bit in flag_bits.items() if mask & bit]
+
+
+# Returned by Observation._resolve() for keys that do not exist, since None is a legitimate value.
+_missing = object()
+
+# Maps each distinct (protocol prefix, keys) layout to its key-resolution table.  Observations with the same layout (in
+# practice, those from the same protocol and source) share one table.
+_key_tables = dict()
+
+
+def _key_table(keys: Iterable[str], prefix: str) -> Dict[str, str]:
+    """
+    Gets the key-resolution table for observations with the given keys: a dictionary from every name by which a key can
+    be requested (with or without the protocol prefix) to the key itself.  A key that exists verbatim takes precedence
+    over one that only exists with the prefix, as in Observation.__getitem__().
+    :param keys: The keys that the observation has.
+    :param prefix: The protocol prefix of the keys ("" for observations not from the API).
+    :return: The table.  It is shared and must not be modified.
+    """
+    layout = (prefix,) + tuple(keys)
+    try:
+        return _key_tables[layout]
+    except KeyError:
+        table = {k[len(prefix):]: k for k in layout[1:] if prefix and k.startswith(prefix)}
+        table.update((k, k) for k in layout[1:])
+        _key_tables[layout] = table
+        return table
+
+
 class Observation:
+    # Observations are created by the million, so they do without a per-instance __dict__.
+    __slots__ = ("_raw", "fromAPI", "flags", "_memo", "_keys")
+
     def __init__(self, header: Optional[List[str]] = None, row: Optional[List[str]] = None,
                  feature: Optional[dict] = None, protocol: Optional[str] = None):
         """
@@ -150,44 +256,96 @@ class Observation:
         :param protocol: The protocol that the CSV file is derived from.
         :raises ValueError: if neither feature nor (header + row + protocol) are provided.
         """
+        self._raw, self.fromAPI = self._parse_properties(header, row, feature, protocol)
+        self.flags = []
+        self._memo = None
+        self._keys = _key_table(self._raw, self.key_prefix)
 
+    @staticmethod
+    def _parse_properties(header: Optional[List[str]], row: Optional[List[str]], feature: Optional[dict],
+                          protocol: Optional[str]) -> Tuple[dict, bool]:
+        """
+        Builds the dictionary of properties for an observation.  See __init__() for the parameters.
+        :return: The properties, and whether they come from the API (as opposed to a CSV file).
+        :raises ValueError: if neither feature nor (header + row + protocol) are provided.
+        """
         if header is not None and row is not None and protocol is not None:
-            self._raw = dict(protocol=protocol)
-            self.fromAPI = False
+            raw = dict(protocol=protocol)
 
-            for c in range(len(header)):
-                column = header[c]
-                try:
-                    self._raw[column] = row[c].strip()
-                except KeyError:
-                    self._raw[column] = None
+            # Pair each column with its value in one pass.  Columns missing from the end of a short row are None.
+            raw.update(zip(header, (v.strip() for v in row)))
+            if len(row) < len(header):
+                raw.update(dict.fromkeys(header[len(row):]))
+            return raw, False
 
         elif feature is not None:
-            self.fromAPI = True
-            self._raw = feature["properties"]
-            self._raw["Observation Latitude"] = feature["geometry"]["coordinates"][1]
-            self._raw["Observation Longitude"] = feature["geometry"]["coordinates"][0]
+            raw = feature["properties"]
+            raw["Observation Latitude"] = feature["geometry"]["coordinates"][1]
+            raw["Observation Longitude"] = feature["geometry"]["coordinates"][0]
+            return raw, True
 
         else:
             raise ValueError("Either 'feature' or all of ('header', 'row', and 'protocol') must be provided.")
 
-        self.flags = []
+    def _resolve(self, item: str):
+        """
+        Gets the requested key, with the protocol prefix if needed, using the key-resolution table.
+        :param item: The key to look for.
+        :return: The value associated with the key, or _missing if the key doesn't exist.
+        """
+        key = self._keys.get(item)
+        return _missing if key is None else self._raw[key]
 
     def __getitem__(self, item: str):
         """
         Attempts to get the requested key.  If the key verbatim does not exist, it will be prefixed with the protocol
         name and retrieval will be reattempted.  Failing that, a KeyError will be raised.
         """
-        try:
-            return self._raw[item]
-        except KeyError:
-            return self._raw[self.key_prefix + item]
+        val = self._resolve(item)
+        if val is _missing:
+            raise KeyError(item)
+        return val
 
     def __contains__(self, item):
         return self.soft_get(item) is not None
 
     def __setitem__(self, key, value):
         self._raw[key] = value
+        # A new key (or a new protocol, which changes the prefix) needs a different table.
+        if self._keys.get(key) != key or key == "protocol":
+            self._keys = _key_table(self._raw, self.key_prefix)
+        self.invalidate_cache()
+
+    def update(self, values: Dict[str, object]):
+        """
+        Sets several keys at once, as if each were set individually (see __setitem__()), but only rebuilding the
+        key-resolution table and forgetting the memoized properties once.
+        :param values: The (key, value) pairs to set.
+        """
+        self._raw.update(values)
+        if any(self._keys.get(key) != key for key in values) or "protocol" in values:
+            self._keys = _key_table(self._raw, self.key_prefix)
+        self.invalidate_cache()
+
+    def _remember(self, name: str, val, raised: Tuple[str, ...] = ()):
+        """
+        Stores the value of a memoized property that was computed elsewhere (e.g. in bulk), as if it had been computed
+        by the property itself.  The flags are recorded but not raised.
+        :param name: The name of the property.
+        :param val: The value.
+        :param raised: The flags that computing the value raises.  Default (), no flags.
+        """
+        if self._memo is None:
+            self._memo = dict()
+        self._memo[name] = (val, raised)
+
+    def invalidate_cache(self):
+        """
+        Forgets the remembered values of the memoized properties (measured_dt, lat, lon, tcc and photo_urls), so that
+        they are recomputed from the current keys the next time they are accessed.  This is done automatically whenever
+        a key is set.
+        """
+        self._memo = None
 
     def soft_get(self, item: str):
         """
@@ -196,10 +354,8 @@ class Observation:
         :param item: They key to look for.
         :return: The value associated with the key (with prefix if needed), or None if the key doesn't exist.
         """
-        try:
-            return self[item]
-        except KeyError:
-            return None
+        val = self._resolve(item)
+        return None if val is _missing else val
 
     @property
     def key_prefix(self) -> str:
@@ -209,28 +365,46 @@ class Observation:
         if not self.fromAPI:
             return ""
         else:
-            return self["protocol"].replace("_", "")
+            return self._raw["protocol"].replace("_", "")
 
-    @property
+    @memoized_property
     def measured_dt(self) -> Optional[datetime]:
         """
         :return: The measurement datetime of this observation, or none if the date and/or time are recorded incorrectly.
         Raises flag DX if the datetime is missing, and DI if the datetime is invalid or malformed.
         """
+        dtstring = self.measured_dt_string
+        if dtstring is None:
+            self.flag("DX")
+            return None
+
+        dt = self.parse_measured_dt(dtstring)
+        if dt is None:
+            self.flag("DI")
+        return dt
+
+    @property
+    def measured_dt_string(self) -> Optional[str]:
+        """
+        :return: The string representing the measurement datetime of this observation, or None if it is missing.
+        """
         # Find or construct the string representing the datetime.
 
         # sic: "Measurement" may be misspelled in the file.
         d = self.try_keys(["Measurment Date (UTC)", "Measurement Date (UTC)"])
         t = self.try_keys(["Measurment Time (UTC)", "Measurement Time (UTC)"])
         if d is not None and t is not None:
-            dtstring = "{}T{}".format(d, t)
+            return "{}T{}".format(d, t)
         else:
-            try:
-                dtstring = self["MeasuredAt"]
-            except KeyError:
-                self.flag("DX")
-                return None
+            return self.soft_get("MeasuredAt")
 
+    @staticmethod
+    def parse_measured_dt(dtstring: str) -> Optional[datetime]:
+        """
+        Converts a measurement datetime string to a datetime.  See tools.parse_datetimes() to convert many at once.
+        :param dtstring: The string, formatted as %Y-%m-%dT%H:%M:%S with or without fractional seconds.
+        :return: The datetime, or None if the string is malformed or is not a real datetime.
+        """
         # Attempt to convert that string to a datetime.
         try:
             return datetime.strptime(dtstring, "%Y-%m-%dT%H:%M:%S")
@@ -239,17 +413,16 @@ class Observation:
             try:
                 return datetime.strptime(dtstring, "%Y-%m-%dT%H:%M:%S.%f")
             except ValueError:
-                self.flag("DI")
                 return None
 
-    @property
+    @memoized_property
     def lat(self) -> Optional[float]:
         """
         :return: The latitude of this observation, or None if the latitude is invalid.
         """
         return self.get_float("Observation Latitude", "LM", "LI")
 
-    @property
+    @memoized_property
     def lon(self) -> Optional[float]:
         """
         :return: The longitude of this observation, or None if it is missing or invalid.
@@ -262,7 +435,7 @@ class Observation:
         :return: The elevation of this observation, or None if it is missing or invalid.
         """
         val = self.get_float(["elevation", "Observation Elevation"], "EX", "EI")
-        if not (-300. <= val <= 6000.):
+        if val is not None and not (-300. <= val <= 6000.):
             self.flag("ER")
         return val
 
@@ -300,7 +473,7 @@ class Observation:
                 total = val if total is None else total + val
         return total
 
-    @property
+    @memoized_property
     def tcc(self) -> Optional[str]:
         """
         :return: Gets the total cloud cover of this observation as a string, or None if it is invalid.  Raises flag CI
@@ -469,10 +642,9 @@ class Observation:
         :return: The value of the key if a match is found; None otherwise.
         """
         for key in keys:
-            try:
-                return self[key]
-            except KeyError:
-                pass
+            val = self._resolve(key)
+            if val is not _missing:
+                return val
         return None
 
     def has_flag(self, flag: str) -> bool:
@@ -511,7 +683,7 @@ class Observation:
         # If we are trying to lower a flag...
         else:
             # If the flag is raised, lower it.
-            if flag is self.flags:
+            if flag in self.flags:
                 self.flags.remove(flag)
                 return True
             # Otherwise, do nothing.
@@ -519,7 +691,8 @@ class Observation:
 
     def check_for_flags(self, land=None):
         """
-        Calls all properties and methods that could raise flags.
+        Calls all properties and methods that could raise flags.  tools.quality_check_flags() performs the same checks
+        over many observations at once, so any change to the checks here must be made there too.
         :param land: The PreparedGeometry for checking whether the location is over land. If None, determination of
         whether a location is a water will be ignored.
         """
@@ -641,13 +814,11 @@ class Observation:
         # Check total contrail count.
         contrails = 0
         for key in ["ShortLivedContrails", "SpreadingContrails", "NonSpreadingContrails"]:
+            # If the key doesn't exist, that's fine.  Ignore it.
+            val = self.soft_get(key)
             try:
-                val = self[key]
-                if (val is not None) and (val.strip() != ""):
+                if (val is not None) and (str(val).strip() != ""):
                     contrails += float(val)
-            # If the key doesn't exist, that's fine.  Ignore it.
-            except KeyError:
-                pass
             # If the value isn't an integer, something's not right.
             except ValueError:
                 self.flag("NI")
@@ -695,6 +866,7 @@ class Observation:
             ER="Elevation is outside of expected range (-300m to 6000m)",
             EX="Elevation attribute is missing",
             LI="Location is not a valid lat-lon pair",
+            LM="Location attribute is missing",
             LW="Location may be over water",
             LZ="Location is at 0 N, 0 E",
             MI="Mosquito larvae count is invalid (not a number or app range)",
@@ -722,6 +894,13 @@ class Observation:
         """
         return self._flag_definitions
 
+    @property
+    def flag_mask(self) -> int:
+        """
+        :return: The flags for this observation as an integer with one bit set per flag (see flag_bit()).
+        """
+        return flags_to_mask(self.flags)
+
     @property
     def flags_english(self) -> List[str]:
         """
@@ -748,14 +927,15 @@ class Observation:
             return (("GLOBE-trained " if self["Is GLOBE Trained"] == "1" else "") +
                     ("citizen science" if self["is Citizen Science"] == "1" else "")).strip()
 
-    @property
+    @memoized_property
     def photo_urls(self) -> Dict[str, str]:
         """
         :return: Gets a dictionary of direction=url pairs for each direction 
         that has a photo for this observation. A key will be absent if no photo 
         exists.  The value of a given key is not guaranteed to be a valid url; 
         in particular, the value may be "rejected" if a photo was submitted but
-        was rejected from the GLOBE database.
+        was rejected from the GLOBE database.  The same dictionary is returned
+        on every access, so it should not be modified.
         
         MODIFICATION HISTORY
         04 Dec 2019 - HM Amos - added keywords for tree and mosquito observations
@@ -763,20 +943,17 @@ class Observation:
         """
         ret = {}
         for direction in ["South", "West", "North", "East", "Upward", "Downward"]:
-            try:
-                ret[direction] = self["{}PhotoUrl".format(direction)]
-            except KeyError:
-                pass          
+            val = self._resolve("{}PhotoUrl".format(direction))
+            if val is not _missing:
+                ret[direction] = val
         for th in ["Tree"]:
-            try:
-                ret[th] = self["{}PhotoUrls".format(th)]
-            except KeyError:
-                pass  
+            val = self._resolve("{}PhotoUrls".format(th))
+            if val is not _missing:
+                ret[th] = val
         for mhm in ["WaterSource","LarvaFullBody"]:
-            try:
-                ret[mhm] = self["{}PhotoUrls".format(mhm)]
-            except KeyError:
-                pass    
+            val = self._resolve("{}PhotoUrls".format(mhm))
+            if val is not _missing:
+                ret[mhm] = val
         return ret
 
     @property
@@ -792,3 +969,151 @@ class Observation:
         :return: Gets the observation's ID or number, whichever is available first.
         """
         return self.try_keys(["ObservationId", "Observation Number"])
+
+
+for _flag in Observation._flag_definitions:
+    flag_bit(_flag)
+
+
+# The keys (without protocol prefix) that are read by the properties of Observation and by quality checking.
+# CompactObservation keeps these directly; all other keys are only decoded on request.  Pass these as the fields to
+# tools.parse_json() or tools.parse_csv() to drop every other key while parsing.
+used_keys = frozenset([
+    "protocol", "DataSource", "Userid", "ObservationId", "Observation Number", "MeasuredAt",
+    "Measurment Date (UTC)", "Measurement Date (UTC)", "Measurment Time (UTC)", "Measurement Time (UTC)",
+    "Observation Latitude", "Observation Longitude", "elevation", "Observation Elevation",
+    "Total Cloud Cover", "CloudCover", "SkyClarity",
+    "Cirrus", "Cirrocumulus", "Cumulus", "Altocumulus", "Stratus", "Nimbostratus", "Altostratus", "Stratocumulus",
+    "Cumulonimbus", "Cirrostratus",
+    "Fog", "Smoke", "Haze", "VolcanicAsh", "Dust", "Sand", "Spray", "HeavyRain", "HeavySnow", "BlowingSnow",
+    "ShortLivedContrails", "SpreadingContrails", "NonSpreadingContrails",
+    "TreeHeightAvgM", "LarvaeCount", "Genus", "MucCode",
+    "SouthPhotoUrl", "WestPhotoUrl", "NorthPhotoUrl", "EastPhotoUrl", "UpwardPhotoUrl", "DownwardPhotoUrl",
+    "TreePhotoUrls", "WaterSourcePhotoUrls", "LarvaFullBodyPhotoUrls",
+    "Is GLOBE Trained", "is Citizen Science", "GEO Satellite",
+    "Aqua Low Cloud Cover", "Aqua Mid Cloud Cover", "Aqua High Cloud Cover",
+    "Terra Low Cloud Cover", "Terra Mid Cloud Cover", "Terra High Cloud Cover",
+    "GEO Low Cloud", "GEO Mid Cloud", "GEO High Cloud", "GEO Low Cloud Cover", "GEO Mid Cloud Cover",
+    "GEO High Cloud Cover",
+])
+
+# Maps each distinct (protocol prefix, kept keys) layout to the kept keys and their key-resolution table, which maps
+# every name by which a kept key can be requested to its position.  Observations with the same layout (in practice,
+# those from the same protocol and source) share one table.
+_compact_tables = dict()
+
+
+class CompactObservation(Observation):
+    """
+    A memory-saving variant of Observation.  The values of the keys that are actually read by this package (see
+    used_keys) are kept in a tuple, positioned by a table shared between observations with the same keys.  All other
+    properties are kept as encoded JSON and only decoded when one of them is requested, which is slow; prefer
+    Observation if arbitrary keys will be read repeatedly.  Keys can be read, set and tested exactly as for Observation.
+    """
+    __slots__ = ("_kept", "_values", "_packed", "_extra")
+
+    def __init__(self, header: Optional[List[str]] = None, row: Optional[List[str]] = None,
+                 feature: Optional[dict] = None, protocol: Optional[str] = None):
+        """
+        See Observation.__init__().
+        """
+        raw, self.fromAPI = self._parse_properties(header, row, feature, protocol)
+        self.flags = []
+        self._memo = None
+        self._extra = None
+
+        prefix = raw["protocol"].replace("_", "") if self.fromAPI else ""
+        layout = (prefix,) + tuple(k for k in raw if self._unprefixed(k, prefix) in used_keys)
+        try:
+            self._kept, self._keys = _compact_tables[layout]
+        except KeyError:
+            kept = layout[1:]
+            table = {self._unprefixed(k, prefix): i for i, k in enumerate(kept)}
+            table.update((k, i) for i, k in enumerate(kept))
+            self._kept, self._keys = _compact_tables[layout] = (kept, table)
+
+        # Short strings such as 'true', 'false' and 'null' recur in nearly every observation; store each only once.
+        self._values = tuple(sys.intern(raw[k]) if type(raw[k]) is str and len(raw[k]) <= 16 else raw[k]
+                             for k in self._kept)
+        self._packed = json.dumps({k: v for k, v in raw.items() if k not in self._keys},
+                                  separators=(",", ":")).encode("utf8")
+
+    @staticmethod
+    def _unprefixed(key: str, prefix: str) -> str:
+        """
+        :return: The key with the protocol prefix removed, if it has one.
+        """
+        return key[len(prefix):] if prefix and key.startswith(prefix) else key
+
+    def _resolve(self, item: str):
+        """
+        See Observation._resolve().
+        """
+        if self._extra is not None:
+            for key in (item, self.key_prefix + item):
+                if key in self._extra:
+                    return self._extra[key]
+
+        i = self._keys.get(item)
+        if i is not None:
+            return self._values[i]
+
+        # A kept key that is not in the table is not in the observation at all, so there is no need to decode.
+        prefix = self.key_prefix
+        if self._unprefixed(item, prefix) in used_keys:
+            return _missing
+        rest = json.loads(self._packed.decode("utf8"))
+        for key in (item, prefix + item):
+            if key in rest:
+                return rest[key]
+        return _missing
+
+    def __setitem__(self, key, value):
+        if self._extra is None:
+            self._extra = dict()
+        self._extra[key] = value
+        self.invalidate_cache()
+
+    def update(self, values: Dict[str, object]):
+        """
+        See Observation.update().
+        """
+        if self._extra is None:
+            self._extra = dict()
+        self._extra.update(values)
+        self.invalidate_cache()
+
+    def __getstate__(self):
+        # The inherited _raw slot is shadowed by the property below, so it must be left out when pickling.
+        names = ("fromAPI", "flags", "_memo", "_keys") + CompactObservation.__slots__
+        return None, {name: getattr(self, name) for name in names}
+
+    @property
+    def key_prefix(self) -> str:
+        """
+        See Observation.key_prefix.
+        """
+        if not self.fromAPI:
+            return ""
+        elif self._extra is not None and "protocol" in self._extra:
+            return self._extra["protocol"].replace("_", "")
+        else:
+            return self._values[self._keys["protocol"]].replace("_", "")
+
+    @property
+    def _raw(self) -> dict:
+        """
+        :return: A newly-decoded dictionary of all the properties of this observation.  Changes to it are not kept.
+        """
+        raw = dict(zip(self._kept, self._values))
+        raw.update(json.loads(self._packed.decode("utf8")))
+        if self._extra is not None:
+            raw.update(self._extra)
+        return raw
+
+    @property
+    def keys(self) -> List[str]:
+        """
+        :return: Gets all the keys associated with this observation.
+        """
+        return list(self._raw.keys())
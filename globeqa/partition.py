@@ -0,0 +1,133 @@
+#------------------------------------------------------------------------------
+# PARTITION.PY
+#
+# PURPOSE
+# Set up the Partition class, which groups a set of GLOBE observations by the
+# values of a few attributes (such as protocol and data source) in one pass, so
+# that any combination of groups can be picked out without scanning the
+# observations again.
+#
+# RESOURCES
+# - GLOBE Observer website: observer.globe.gov
+# - GLOBE Data User Guide: https://www.globe.gov/globe-data/globe-data-user-guide
+# - Download the GLOBE Observer app: https://observer.globe.gov/about/get-the-app
+#
+# CITATION
+# Amos, H.M. and M.J. Starke et al., 2020, GLOBE Observer
+# Data:2016-2019, in prep. *Check back for updated journal
+# information and publication DOI*
+#
+# CORRESPONDING AUTHOR
+# Helen Amos, helen.m.amos@nasa.gov
+#
+# DISCLAIMER
+# This code comes as is without guarantees of any kind.
+#------------------------------------------------------------------------------
+
+from globeqa.observation import Observation
+from globeqa.table import ObservationTable
+import numpy as np
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+
+class Partition:
+    def __init__(self, obs: Union[List[Observation], ObservationTable], keys: Iterable[str],
+                 columns: Dict[str, Iterable[Any]]):
+        """
+        A Partition groups observations by the values of some of their attributes.  Use tools.partition() to make one.
+        Subsets are picked with select() (or counted with count()) by giving the values wanted for any of the
+        attributes; each distinct subset is only gathered the first time it is asked for.
+        :param obs: The observations, or an ObservationTable.
+        :param keys: The attributes to group by.
+        :param columns: The value of each attribute for each observation (None where missing), in the same order as
+        obs.
+        :raises ValueError: If a column is missing or not the same length as obs.
+        """
+        self.obs = obs
+        self.keys = tuple(keys)
+        for key in self.keys:
+            if key not in columns or len(columns[key]) != len(obs):
+                raise ValueError("Argument 'columns' must have a value of '{}' for every observation.".format(key))
+
+        # Group the positions of the observations by their values, in one pass.
+        groups = dict()
+        for i, values in enumerate(zip(*(columns[key] for key in self.keys))):
+            try:
+                groups[values].append(i)
+            except KeyError:
+                groups[values] = [i]
+        self.groups = {values: np.array(positions, dtype=np.intp) for values, positions in groups.items()}
+        self._views = dict()
+
+    def __len__(self) -> int:
+        """
+        :return: The number of groups.
+        """
+        return len(self.groups)
+
+    def values(self, key: str) -> List[Any]:
+        """
+        :param key: One of the attributes grouped by.
+        :return: The distinct values of that attribute, in order of first appearance.
+        """
+        column = self.keys.index(key)
+        return list(dict.fromkeys(values[column] for values in self.groups))
+
+    def _matching_groups(self, criteria: Dict[str, Any]) -> Tuple[Tuple[Any, ...], ...]:
+        """
+        :return: The groups whose values meet the criteria (see select()).
+        :raises ValueError: If a criterion is for an attribute that was not grouped by.
+        """
+        tests = []
+        for key, wanted in criteria.items():
+            if key not in self.keys:
+                raise ValueError("Observations were not grouped by '{}'; only by {}.".format(key, list(self.keys)))
+            column = self.keys.index(key)
+            if callable(wanted):
+                tests.append(lambda values, column=column, wanted=wanted: wanted(values[column]))
+            elif isinstance(wanted, (list, tuple, set, frozenset)):
+                tests.append(lambda values, column=column, wanted=wanted: values[column] in wanted)
+            else:
+                tests.append(lambda values, column=column, wanted=wanted: values[column] == wanted)
+        return tuple(values for values in self.groups if all(test(values) for test in tests))
+
+    def positions(self, criteria: Optional[Dict[str, Any]] = None, **kwargs) -> np.ndarray:
+        """
+        :return: The positions of the observations that meet the criteria (see select()), in ascending order.
+        """
+        criteria = dict(criteria or {}, **kwargs)
+        matching = self._matching_groups(criteria)
+        if len(matching) == 0:
+            return np.empty(0, dtype=np.intp)
+        return np.sort(np.concatenate([self.groups[values] for values in matching]))
+
+    def select(self, criteria: Optional[Dict[str, Any]] = None,
+               **kwargs) -> Union[List[Observation], ObservationTable]:
+        """
+        Picks out the observations whose attributes have the given values, e.g. select(protocol="sky_conditions",
+        DataSource="GLOBE Observer App").
+        :param criteria: For each attribute to pick by, the value wanted.  This may be a single value, a list (or other
+        collection) of acceptable values, or a function that takes the value and returns whether it is acceptable.
+        Attributes whose names are not valid Python names can only be given this way.  Default None.
+        :param kwargs: More criteria, by attribute name.
+        :return: The observations that meet every criterion, in their original order (a table if this Partition was made
+        from an ObservationTable).  The same list is returned each time the same groups are picked, so it should not be
+        modified.
+        :raises ValueError: If a criterion is for an attribute that was not grouped by.
+        """
+        criteria = dict(criteria or {}, **kwargs)
+        matching = self._matching_groups(criteria)
+        if matching not in self._views:
+            positions = self.positions(criteria)
+            if isinstance(self.obs, ObservationTable):
+                self._views[matching] = self.obs.where(positions)
+            else:
+                self._views[matching] = [self.obs[i] for i in positions]
+        return self._views[matching]
+
+    def count(self, criteria: Optional[Dict[str, Any]] = None, **kwargs) -> int:
+        """
+        :return: The number of observations that meet the criteria (see select()), without gathering them.
+        """
+        matching = self._matching_groups(dict(criteria or {}, **kwargs))
+        return sum(len(self.groups[values]) for values in matching)
@@ -0,0 +1,219 @@
+#------------------------------------------------------------------------------
+# SPATIALINDEX.PY
+#
+# PURPOSE
+# Set up the SpatialIndex class, which sorts the locations of a set of GLOBE
+# observations into a grid of latitude-longitude cells once, so that the
+# observations in a region, within a distance of a point, or nearest to a
+# point can be found by looking only at nearby cells.
+#
+# RESOURCES
+# - GLOBE Observer website: observer.globe.gov
+# - GLOBE Data User Guide: https://www.globe.gov/globe-data/globe-data-user-guide
+# - Download the GLOBE Observer app: https://observer.globe.gov/about/get-the-app
+#
+# CITATION
+# Amos, H.M. and M.J. Starke et al., 2020, GLOBE Observer
+# Data:2016-2019, in prep. *Check back for updated journal
+# information and publication DOI*
+#
+# CORRESPONDING AUTHOR
+# Helen Amos, helen.m.amos@nasa.gov
+#
+# DISCLAIMER
+# This code comes as is without guarantees of any kind.
+#------------------------------------------------------------------------------
+
+import numpy as np
+from typing import Tuple
+
+
+# The mean radius of the Earth, in km.
+earth_radius = 6371.0088
+
+# Boxes around circles are widened by this much (in degrees) to allow for rounding.
+_margin = 1e-9
+
+
+def _wrap(lon):
+    """
+    :return: The longitude(s), wrapped into -180 to 180 if outside that range.
+    """
+    lon = np.asarray(lon, dtype=np.float64)
+    return np.where(np.abs(lon) <= 180., lon, (lon + 180.) % 360. - 180.)
+
+
+def great_circle_distance(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """
+    Calculates the great-circle distance between points with the haversine formula.  Arguments may be floats or arrays.
+    :param lat1: The latitude of the first point(s), in degrees.
+    :param lon1: The longitude of the first point(s), in degrees.
+    :param lat2: The latitude of the second point(s), in degrees.
+    :param lon2: The longitude of the second point(s), in degrees.
+    :return: The distance(s), in km.
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=np.float64)) for x in (lat1, lon1, lat2, lon2))
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * earth_radius * np.arcsin(np.sqrt(np.clip(h, 0., 1.)))
+
+
+class SpatialIndex:
+    def __init__(self, lat: np.ndarray, lon: np.ndarray, cell_size: float = 1.0):
+        """
+        A SpatialIndex sorts the locations of a set of observations into cells of cell_size degrees of latitude and
+        longitude.  Observations without a valid location are left out.  Use tools.spatial_index() to build one for a
+        list of observations or an ObservationTable.
+        :param lat: The latitude of each observation, in degrees (NaN where missing or invalid).
+        :param lon: The longitude of each observation, in degrees (NaN where missing or invalid).  Longitudes outside
+        -180 to 180 are wrapped into that range.
+        :param cell_size: The size of each cell, in degrees.  Default 1.0.
+        :raises ValueError: If lat and lon are not the same length, or cell_size is not positive.
+        """
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        if len(lat) != len(lon):
+            raise ValueError("Arguments 'lat' and 'lon' must be the same length.")
+        if not cell_size > 0:
+            raise ValueError("Argument 'cell_size' must be positive.")
+
+        self.size = len(lat)
+        self.cell_size = float(cell_size)
+        self.rows = int(np.ceil(180. / self.cell_size))
+        self.cols = int(np.ceil(360. / self.cell_size))
+
+        valid = np.flatnonzero(np.isfinite(lat) & np.isfinite(lon) & (np.abs(lat) <= 90.))
+        self.lat = lat
+        self.lon = _wrap(lon)
+
+        # Sort the observations by cell, and record where each cell's observations start.
+        cells = self._rows(self.lat[valid]) * self.cols + self._cols(self.lon[valid])
+        by_cell = np.argsort(cells, kind="stable")
+        self.order = valid[by_cell]
+        self.starts = np.concatenate([[0], np.cumsum(np.bincount(cells, minlength=self.rows * self.cols))])
+
+    def __len__(self) -> int:
+        """
+        :return: The number of observations indexed, including those without a valid location.
+        """
+        return self.size
+
+    def _rows(self, lat: np.ndarray) -> np.ndarray:
+        """
+        :return: The row of cells that each latitude falls in.
+        """
+        return np.clip(np.floor((np.asarray(lat) + 90.) / self.cell_size), 0, self.rows - 1).astype(np.intp)
+
+    def _cols(self, lon: np.ndarray) -> np.ndarray:
+        """
+        :return: The column of cells that each (wrapped) longitude falls in.
+        """
+        return np.clip(np.floor((np.asarray(lon) + 180.) / self.cell_size), 0, self.cols - 1).astype(np.intp)
+
+    def _candidates(self, south: float, west: float, north: float, east: float, wraps: bool) -> np.ndarray:
+        """
+        :param wraps: Whether the box crosses the antimeridian (i.e. west is greater than east).  This must be decided
+        from the longitudes rather than the columns, since both edges of a box that wraps almost all the way around can
+        fall in the same column.
+        :return: The positions of the observations in every cell that overlaps the box.
+        """
+        first_row, last_row = self._rows([south, north])
+        first_col, last_col = self._cols([west, east])
+        if not wraps:
+            col_ranges = [(first_col, last_col)]
+        elif first_col == last_col:
+            # The two parts of the box share a column, so together they cover every column.
+            col_ranges = [(0, self.cols - 1)]
+        else:
+            col_ranges = [(first_col, self.cols - 1), (0, last_col)]
+
+        parts = [np.empty(0, dtype=np.intp)]
+        for row in range(first_row, last_row + 1):
+            for first, last in col_ranges:
+                parts.append(self.order[self.starts[row * self.cols + first]:self.starts[row * self.cols + last + 1]])
+        return np.concatenate(parts)
+
+    def in_bbox(self, south: float, west: float, north: float, east: float) -> np.ndarray:
+        """
+        Finds the observations in a box of latitude and longitude, edges included.
+        :param south: The southernmost latitude.
+        :param west: The westernmost longitude.  If west is greater than east, the box crosses the antimeridian.
+        :param north: The northernmost latitude.
+        :param east: The easternmost longitude.
+        :return: The positions of the observations in the box, in ascending order.
+        :raises ValueError: If south is greater than north.
+        """
+        if south > north:
+            raise ValueError("Argument 'south' must not be greater than argument 'north'.")
+        west, east = float(_wrap(west)), float(_wrap(east))
+
+        wraps = west > east
+        positions = self._candidates(south, west, north, east, wraps)
+        lat, lon = self.lat[positions], self.lon[positions]
+        inside = (lat >= south) & (lat <= north)
+        if not wraps:
+            inside &= (lon >= west) & (lon <= east)
+        else:
+            inside &= (lon >= west) | (lon <= east)
+        return np.sort(positions[inside])
+
+    def _within(self, lat: float, lon: float, radius: float) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: The positions of the observations within radius km of the point, in ascending order, and their
+        distances from the point.
+        """
+        # Find the box of latitude and longitude that contains the circle; near a pole, that is every longitude.
+        angle = np.degrees(radius / earth_radius) + _margin
+        south, north = max(lat - angle, -90.), min(lat + angle, 90.)
+        if south == -90. or north == 90. or angle >= 90.:
+            positions = self._candidates(south, -180., north, 180., False)
+        else:
+            span = np.degrees(np.arcsin(min(np.sin(np.radians(angle)) / np.cos(np.radians(lat)), 1.))) + _margin
+            if span >= 180.:
+                positions = self._candidates(south, -180., north, 180., False)
+            else:
+                west, east = float(_wrap(lon - span)), float(_wrap(lon + span))
+                positions = self._candidates(south, west, north, east, west > east)
+
+        distances = great_circle_distance(lat, lon, self.lat[positions], self.lon[positions])
+        inside = distances <= radius
+        positions, distances = positions[inside], distances[inside]
+        ascending = np.argsort(positions)
+        return positions[ascending], distances[ascending]
+
+    def within(self, lat: float, lon: float, radius: float) -> np.ndarray:
+        """
+        Finds the observations within a distance of a point, along the surface of the Earth.
+        :param lat: The latitude of the point.
+        :param lon: The longitude of the point.
+        :param radius: The distance, in km.
+        :return: The positions of the observations within the distance, in ascending order.
+        :raises ValueError: If radius is negative.
+        """
+        if radius < 0:
+            raise ValueError("Argument 'radius' must not be negative.")
+        return self._within(lat, lon, radius)[0]
+
+    def nearest(self, lat: float, lon: float, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the observations nearest to a point, along the surface of the Earth.
+        :param lat: The latitude of the point.
+        :param lon: The longitude of the point.
+        :param k: The number of observations to find.  Default 1.
+        :return: The positions of the k nearest observations (fewer if fewer have a valid location), nearest first, and
+        their distances from the point in km.
+        :raises ValueError: If k is less than 1.
+        """
+        if k < 1:
+            raise ValueError("Argument 'k' must be at least 1.")
+
+        # Search ever-wider circles until one holds at least k observations.  Every observation outside the circle is
+        # farther away than every one inside it, so the k nearest in the circle are the k nearest overall.
+        radius = earth_radius * np.radians(self.cell_size)
+        while True:
+            positions, distances = self._within(lat, lon, radius)
+            if len(positions) >= k or radius >= np.pi * earth_radius:
+                break
+            radius *= 2
+
+        nearest = np.argsort(distances, kind="stable")[:k]
+        return positions[nearest], distances[nearest]
@@ -0,0 +1,199 @@
+#------------------------------------------------------------------------------
+# TABLE.PY
+#  
+# PURPOSE
+# Set up the ObservationTable class, which holds the commonly-used fields of
+# many GLOBE observations as NumPy arrays so that they can be analyzed without
+# looping over every observation.
+#
+# RESOURCES
+# - GLOBE Observer website: observer.globe.gov
+# - GLOBE Data User Guide: https://www.globe.gov/globe-data/globe-data-user-guide
+# - Download the GLOBE Observer app: https://observer.globe.gov/about/get-the-app
+#
+# CITATION
+# Amos, H.M. and M.J. Starke et al., 2020, GLOBE Observer
+# Data:2016-2019, in prep. *Check back for updated journal
+# information and publication DOI*
+#
+# CORRESPONDING AUTHOR
+# Helen Amos, helen.m.amos@nasa.gov
+#
+# DISCLAIMER
+# This code comes as is without guarantees of any kind. 
+#------------------------------------------------------------------------------
+
+from globeqa.observation import Observation, flags_to_mask, mask_to_flags
+import numpy as np
+from tqdm import tqdm
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+
+# The photo directions/types recorded in the columns, matching the keys of Observation.photo_urls.
+_photo_columns = ["South", "West", "North", "East", "Upward", "Downward", "Tree", "WaterSource", "LarvaFullBody"]
+
+
+def observations_to_columns(obs: Iterable[Observation], tqdm=tqdm) -> Dict[str, np.ndarray]:
+    """
+    Extracts the commonly-used fields of the observations into one array per field.
+    :param obs: The observations.  This may be a generator (e.g. tools.iter_json()), in which case the observations
+    themselves are never all held in memory at once.
+    :param tqdm: The wrapper around for-loops in this function.  Default tqdm, which will print a progress bar.
+    :return: A dictionary of equal-length arrays:
+        id          - ObservationId (str, "" if missing)
+        protocol    - protocol (str)
+        DataSource  - DataSource (str, "" if missing)
+        Userid      - Userid (str, "" if missing)
+        lat, lon    - latitude and longitude (float64, NaN if missing or invalid)
+        measured_dt - measurement datetime (datetime64[us], NaT if missing or invalid)
+        photo_X     - for each X in South, West, North, East, Upward, Downward, Tree, WaterSource and LarvaFullBody,
+                      whether a photo URL (other than 'null') is present (bool)
+        flags       - the flags raised on the observation so far, comma-separated (str)
+    """
+    columns = dict(id=[], protocol=[], DataSource=[], Userid=[], lat=[], lon=[], measured_dt=[], flags=[])
+    for direction in _photo_columns:
+        columns["photo_" + direction] = []
+
+    for ob in tqdm(obs, desc="Extracting columns"):
+        # Record flags before reading any properties, since reading them can raise flags.
+        columns["flags"].append(",".join(ob.flags))
+        columns["id"].append(ob.id or "")
+        columns["protocol"].append(ob["protocol"])
+        columns["DataSource"].append(ob.soft_get("DataSource") or "")
+        columns["Userid"].append(str(ob.soft_get("Userid") or ""))
+        lat, lon = ob.lat, ob.lon
+        columns["lat"].append(np.nan if lat is None else lat)
+        columns["lon"].append(np.nan if lon is None else lon)
+        dt = ob.measured_dt
+        columns["measured_dt"].append(np.datetime64("NaT") if dt is None else np.datetime64(dt, "us"))
+        photo_urls = ob.photo_urls
+        for direction in _photo_columns:
+            columns["photo_" + direction].append(photo_urls.get(direction) not in [None, "null"])
+
+    ret = dict()
+    for key, values in columns.items():
+        if key in ["lat", "lon"]:
+            ret[key] = np.array(values, dtype=np.float64)
+        elif key == "measured_dt":
+            ret[key] = np.array(values, dtype="datetime64[us]")
+        elif key.startswith("photo_"):
+            ret[key] = np.array(values, dtype=bool)
+        else:
+            ret[key] = np.array(values, dtype=str)
+    return ret
+
+
+class ObservationTable:
+    def __init__(self, columns: Dict[str, np.ndarray], obs: Optional[List[Observation]] = None):
+        """
+        An ObservationTable holds the commonly-used fields of a set of observations as one NumPy array per field (see
+        observations_to_columns()), and optionally the observations themselves.  Columns are accessed by name
+        (table["lat"]); individual observations by position (table[0]).  Indexing with a boolean mask, an array of
+        positions or a slice gives a new table of just those observations.  The tools.filter_*() functions and
+        tools.get_flag_counts() accept tables and answer using the columns.
+        :param columns: The columns.  A 'flag_mask' column (uint64; see observation.flag_bit()) is derived from the
+        'flags' column if it is not given.
+        :param obs: The observations that the columns were extracted from, in the same order.  Default None, in which
+        case observations are rebuilt from the columns on demand (see observation()).
+        :raises ValueError: If the columns (and obs, if given) are not all the same length.
+        """
+        lengths = set(len(column) for column in columns.values())
+        if obs is not None:
+            lengths.add(len(obs))
+        if len(lengths) > 1:
+            raise ValueError("All columns (and 'obs', if given) must be the same length.")
+
+        self.columns = dict(columns)
+        self._obs = obs
+        if "flag_mask" not in self.columns:
+            self.columns["flag_mask"] = np.fromiter((flags_to_mask(f.split(",")) if f else 0 for f in columns["flags"]),
+                                                    dtype=np.uint64, count=len(columns["flags"]))
+
+    @classmethod
+    def from_observations(cls, obs: List[Observation], tqdm=tqdm) -> "ObservationTable":
+        """
+        Creates a table from observations.
+        :param obs: The observations.
+        :param tqdm: The wrapper around for-loops in this function.  Default tqdm, which will print a progress bar.
+        :return: The table, which keeps the observations themselves for observation().
+        """
+        obs = list(obs)
+        return cls(observations_to_columns(obs, tqdm=tqdm), obs)
+
+    def __len__(self) -> int:
+        return len(self.columns["protocol"])
+
+    def __getitem__(self, key: Union[str, int, slice, np.ndarray, List[int]]):
+        """
+        :param key: A column name, a position, or a boolean mask, array of positions or slice.
+        :return: The column, the observation at the position (see observation()), or a new table of the selected
+        observations, respectively.
+        """
+        if type(key) is str:
+            return self.columns[key]
+        elif isinstance(key, (int, np.integer)):
+            return self.observation(int(key))
+        else:
+            return self.where(key)
+
+    def __iter__(self) -> Iterator[Observation]:
+        return (self.observation(i) for i in range(len(self)))
+
+    def where(self, selection: Union[slice, np.ndarray, List[int]]) -> "ObservationTable":
+        """
+        Selects some of the observations.
+        :param selection: A boolean mask, array of positions or slice.
+        :return: A new table of the selected observations.  Its columns are copies unless selection is a slice.
+        """
+        if not isinstance(selection, slice):
+            selection = np.asarray(selection)
+        columns = {name: column[selection] for name, column in self.columns.items()}
+        if self._obs is None:
+            obs = None
+        elif isinstance(selection, slice):
+            obs = self._obs[selection]
+        else:
+            if selection.dtype == bool:
+                selection = np.flatnonzero(selection)
+            obs = [self._obs[i] for i in selection]
+        return ObservationTable(columns, obs)
+
+    def observation(self, i: int) -> Observation:
+        """
+        Gets one observation.  If this table was made from observations, that observation is returned; otherwise an
+        observation is rebuilt with only the properties that the columns hold (ObservationId, protocol, DataSource,
+        Userid, MeasuredAt and location) and the flags.
+        :param i: The position of the observation.
+        :return: The observation.
+        """
+        if self._obs is not None:
+            return self._obs[i]
+
+        lat, lon, dt = self.columns["lat"][i], self.columns["lon"][i], self.columns["measured_dt"][i]
+        properties = dict(ObservationId=str(self.columns["id"][i]), protocol=str(self.columns["protocol"][i]),
+                          DataSource=str(self.columns["DataSource"][i]), Userid=str(self.columns["Userid"][i]))
+        if not np.isnat(dt):
+            properties["MeasuredAt"] = np.datetime_as_string(dt, unit="us")
+        feature = dict(properties=properties,
+                       geometry=dict(coordinates=[None if np.isnan(lon) else float(lon),
+                                                  None if np.isnan(lat) else float(lat)]))
+        ob = Observation(feature=feature)
+        ob.flags = mask_to_flags(int(self.columns["flag_mask"][i]))
+        return ob
+
+    @property
+    def observations(self) -> List[Observation]:
+        """
+        :return: All the observations (see observation()).
+        """
+        return self._obs if self._obs is not None else list(self)
+
+    def refresh_flags(self):
+        """
+        Updates the 'flags' and 'flag_mask' columns from the observations, e.g. after tools.do_quality_check().  Has no
+        effect if this table was not made from observations.
+        """
+        if self._obs is not None:
+            self.columns["flags"] = np.array([",".join(ob.flags) for ob in self._obs], dtype=str)
+            self.columns["flag_mask"] = np.fromiter((flags_to_mask(ob.flags) for ob in self._obs), dtype=np.uint64,
+                                                    count=len(self._obs))
@@ -0,0 +1,85 @@
+#------------------------------------------------------------------------------
+# TIMEINDEX.PY
+#
+# PURPOSE
+# Set up the TimeIndex class, which sorts the measurement datetimes of a set
+# of GLOBE observations once so that the observations in any range of
+# datetimes or hours of the day can be found by binary search.
+#
+# RESOURCES
+# - GLOBE Observer website: observer.globe.gov
+# - GLOBE Data User Guide: https://www.globe.gov/globe-data/globe-data-user-guide
+# - Download the GLOBE Observer app: https://observer.globe.gov/about/get-the-app
+#
+# CITATION
+# Amos, H.M. and M.J. Starke et al., 2020, GLOBE Observer
+# Data:2016-2019, in prep. *Check back for updated journal
+# information and publication DOI*
+#
+# CORRESPONDING AUTHOR
+# Helen Amos, helen.m.amos@nasa.gov
+#
+# DISCLAIMER
+# This code comes as is without guarantees of any kind.
+#------------------------------------------------------------------------------
+
+from datetime import datetime
+import numpy as np
+from typing import Iterable, Optional
+
+
+# The length of an hour, in the units of the index (microseconds).
+_hour = 3600 * 1000000
+
+
+class TimeIndex:
+    def __init__(self, dts: np.ndarray):
+        """
+        A TimeIndex holds the measurement datetimes of a set of observations in sorted order, together with the
+        position of each in the set, and likewise their times of day.  Observations without a datetime are left out.
+        Use tools.time_index() to build one for a list of observations or an ObservationTable.
+        :param dts: The measurement datetime of each observation, as datetime64 (NaT where missing or invalid).
+        """
+        dts = np.asarray(dts, dtype="datetime64[us]")
+        self.size = len(dts)
+
+        valid = np.flatnonzero(~np.isnat(dts))
+        self.order = valid[np.argsort(dts[valid], kind="stable")]
+        self.times = dts[self.order]
+
+        # Microseconds since midnight.
+        time_of_day = (self.times - self.times.astype("datetime64[D]")).astype(np.int64)
+        by_time_of_day = np.argsort(time_of_day, kind="stable")
+        self.times_of_day = time_of_day[by_time_of_day]
+        self.order_by_time_of_day = self.order[by_time_of_day]
+
+    def __len__(self) -> int:
+        """
+        :return: The number of observations indexed, including those without a datetime.
+        """
+        return self.size
+
+    def between(self, earliest: Optional[datetime] = None, latest: Optional[datetime] = None) -> np.ndarray:
+        """
+        Finds the observations measured in a range of datetimes.
+        :param earliest: The earliest datetime in the range.  Default None, for no limit.
+        :param latest: The first datetime after the range (observations at exactly latest are not in the range).
+        Default None, for no limit.
+        :return: The positions of the observations in the range, in ascending order.
+        """
+        first = 0 if earliest is None else np.searchsorted(self.times, np.datetime64(earliest, "us"), side="left")
+        last = len(self.times) if latest is None else np.searchsorted(self.times, np.datetime64(latest, "us"),
+                                                                     side="left")
+        return np.sort(self.order[first:max(first, last)])
+
+    def at_hours(self, hours: Iterable[int]) -> np.ndarray:
+        """
+        Finds the observations measured during certain hours of the day.
+        :param hours: The hours of the day (0 through 23).
+        :return: The positions of the observations measured during any of the hours, in ascending order.
+        """
+        parts = [np.empty(0, dtype=np.intp)]
+        for hour in sorted(set(hours)):
+            first, last = np.searchsorted(self.times_of_day, [hour * _hour, (hour + 1) * _hour], side="left")
+            parts.append(self.order_by_time_of_day[first:last])
+        return np.sort(np.concatenate(parts))
@@ -26,66 +26,213 @@
 # This code comes as is without guarantees of any kind. 
 #------------------------------------------------------------------------------
 
+import cartopy
 import cartopy.io.shapereader as shpreader
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import closing
+import csv
 from datetime import date, datetime, timedelta
+import hashlib
 import json
+import mmap
+import re
 from netCDF4 import Dataset
-from globeqa.observation import Observation
+import numpy as np
+from globeqa.landmask import LandMask, contains_xy
+from globeqa.npzfile import savez_atomic
+from globeqa.observation import CompactObservation, Observation, flag_bits, flags_to_mask, used_keys
+from globeqa.partition import Partition
+from globeqa.spatialindex import SpatialIndex
+from globeqa.table import ObservationTable, observations_to_columns
+from globeqa.timeindex import TimeIndex
 from operator import itemgetter
-from os.path import isfile, join
+from os import remove, replace, stat
+from os.path import basename, dirname, getsize, isfile, join, splitext
+import shapely.wkb
 from shapely.ops import unary_union
 from shapely.prepared import prep
 from shutil import copyfileobj
+import time
 from tqdm import tqdm
-from typing import List, Dict, Optional, Union, Tuple, Iterable, Callable, Any
-from urllib.request import urlopen
+from typing import List, Dict, Optional, Union, Tuple, Iterable, Iterator, Callable, Any, FrozenSet
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 
 
-def parse_csv(fp: str, count: int = 1e30, protocol: Optional[str] = "sky_conditions", tqdm=tqdm) -> List[Observation]:
+def iter_csv(fp: str, protocol: Optional[str] = "sky_conditions", compact: bool = False,
+             fields: Optional[Iterable[str]] = None) -> Iterator[Observation]:
     """
-    Parse a CSV file containing GLOBE observations.
+    Lazily parses a CSV file containing GLOBE observations, yielding one observation per row.  The file is memory-mapped
+    and read in a single pass, and quoted fields (including those containing commas) are handled correctly.  Blank
+    lines are skipped.
+    :param fp: The path to the CSV file.  The file is read as UTF-8.
+    :param protocol: The protocol that the CSV file comes from.  Default 'sky_conditions'.
+    :param compact: Whether to create CompactObservations, which use less memory.  Default False.
+    :param fields: The columns to keep (see observation.used_keys for those read by this package); all others are
+    dropped as each row is read.  Default None, which keeps every column.
+    :returns: A generator of observations, in the order in which the rows appear in the file.
+    """
+    cls = CompactObservation if compact else Observation
+
+    # mmap cannot map an empty file.
+    if getsize(fp) == 0:
+        return
+
+    with open(fp, "rb") as f:
+        with closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as mm:
+            rows = csv.reader(line.decode("utf8") for line in iter(mm.readline, b""))
+            # Set aside the header and strip each piece.  It is shared by every row.
+            header = [h.strip() for h in next(rows, [])]
+            # Blank lines (e.g. a trailing empty line) are read as empty rows, which are not observations.
+            if fields is None:
+                for row in rows:
+                    if not row:
+                        continue
+                    yield cls(header, row, protocol=protocol)
+                return
+
+            # The positions of the columns to keep are worked out once, from the header.  They are in ascending order,
+            # so the kept values of a short row still line up with the start of the kept header.
+            fields = set(fields)
+            kept = [i for i, h in enumerate(header) if h in fields]
+            header = [header[i] for i in kept]
+            for row in rows:
+                if not row:
+                    continue
+                yield cls(header, [row[i] for i in kept if i < len(row)], protocol=protocol)
+
+
+def parse_csv(fp: str, count: int = 1e30, protocol: Optional[str] = "sky_conditions", compact: bool = False,
+              fields: Optional[Iterable[str]] = None, tqdm=tqdm) -> List[Observation]:
+    """
+    Parse a CSV file containing GLOBE observations.  See iter_csv() to process the rows one at a time instead.
     :param fp: The path to the CSV file.
     :param count: The maximum number of observations to parse.  Default 1e30.
     :param protocol: The protocol that the CSV file comes from.  Default 'sky_conditions'.
+    :param compact: Whether to create CompactObservations, which use less memory.  Default False.
+    :param fields: The columns to keep (see iter_csv()).  Default None, which keeps every column.
     :param tqdm: The wrapper around for-loops in this function.  Default tqdm, which will print a progress bar.
     :return: The observations.
     """
-
-    # Prepare to collect observations.
     observations = []
-    with open(fp, "r") as f:
-        # Set aside the header, split it, and strip each piece.
-        header = f.readline().split(',')
-        header = [h.strip() for h in header]
-        # Determine number of lines for tqdm.
-        line_count = sum(1 for _ in open(fp, 'rb')) - 1
-        # Loop through each line.
-        for line in tqdm(f, total=line_count, desc="Reading CSV file"):
-            # If limited by count, exit.
-            if len(observations) >= count:
-                break
-            # Split the line and create an Observation for it.
-            s = line.split(',')
-            observations.append(Observation(header, s, protocol=protocol))
+    for ob in tqdm(iter_csv(fp, protocol, compact, fields), desc="Reading CSV file"):
+        # If limited by count, exit.
+        if len(observations) >= count:
+            break
+        observations.append(ob)
 
     return observations
 
 
+def file_sha256(fp: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Computes the SHA-256 checksum of a file without reading it into memory all at once.
+    :param fp: The path to the file.
+    :param chunk_size: The number of bytes to read at a time.  Default 1 MiB.
+    :return: The hexadecimal digest.
+    """
+    sha = hashlib.sha256()
+    with open(fp, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+# The end of a complete download: the last feature (or the opening bracket of an empty array), then the ends of the
+# features array and of the top-level object.
+_feature_collection_end = re.compile(rb"[}\[]\s*\]\s*}\s*$")
+
+
+def _ends_like_feature_collection(fp: str) -> bool:
+    """
+    :param fp: The path to a downloaded file.
+    :return: Whether the file ends by closing the features array and then the top-level object.  A file that was cut
+    off, even just after the end of a feature, does not.
+    """
+    with open(fp, "rb") as f:
+        f.seek(max(getsize(fp) - 64, 0))
+        return _feature_collection_end.search(f.read()) is not None
+
+
+def download_is_complete(fp: str, verify_checksum: bool = False) -> bool:
+    """
+    Determines whether a file produced by download_from_api() is complete.  Completed downloads have a sidecar file
+    (fp + ".meta") recording their size and checksum.  Files without a sidecar (e.g. from older versions of this code)
+    are accepted only if they end by closing the features array and the JSON object.
+    :param fp: The path to the downloaded file.
+    :param verify_checksum: Whether to also recompute the checksum and compare it to the sidecar.  Default False, which
+    only compares the size.
+    :return: Whether the file exists and appears complete.
+    """
+    if not isfile(fp):
+        return False
+
+    meta_fp = fp + ".meta"
+    if isfile(meta_fp):
+        try:
+            with open(meta_fp, "r") as f:
+                meta = json.load(f)
+            if getsize(fp) != meta["bytes"]:
+                return False
+            return (not verify_checksum) or file_sha256(fp) == meta["sha256"]
+        except (ValueError, KeyError):
+            return False
+
+    # No sidecar: check the tail of the file for the end of the features array and the top-level object.
+    return _ends_like_feature_collection(fp)
+
+
+def _resume_validator(headers) -> Optional[Dict[str, str]]:
+    """
+    Picks the header of a response that identifies its content, for resuming a download of it with If-Range.
+    :param headers: The headers of the response.
+    :return: {"If-Range": value}, using the ETag if it is a strong one and otherwise Last-Modified, or None if the
+    response has neither (in which case a partial download of it cannot be safely resumed).
+    """
+    etag = headers.get("ETag")
+    if etag is not None and not etag.startswith("W/"):
+        return {"If-Range": etag}
+    last_modified = headers.get("Last-Modified")
+    if last_modified is not None:
+        return {"If-Range": last_modified}
+    return None
+
+
+def _discard_partial_download(part_dest: str):
+    """
+    Deletes a partial download and the record of the response it came from, so that the next attempt starts over.
+    :param part_dest: The path to the partial download.
+    """
+    for fp in [part_dest, part_dest + ".validator"]:
+        if isfile(fp):
+            remove(fp)
+
+
 def download_from_api(protocols: List[str], start: Union[date, datetime], end: Optional[Union[date, datetime]] = None,
-                      download_dest: str = "%P_%S_%E.json", check_existing: bool = True) -> str:
+                      download_dest: str = "%P_%S_%E.json", check_existing: bool = True, retries: int = 3,
+                      backoff: float = 1.0) -> str:
     """
-    Downloads from the GLOBE API.
+    Downloads from the GLOBE API.  The download is written to download_dest + ".part" and only renamed to download_dest
+    once it is complete, at which point a sidecar file (download_dest + ".meta") recording its size and checksum is also
+    written.  If the transfer is interrupted, the partial file is kept and the next attempt resumes from where it left
+    off, provided that the server identified the response (by ETag or Last-Modified, kept in download_dest +
+    ".part.validator") and confirms that it has not changed since; otherwise the download starts over.
     :param protocols: The protocols to download.
     :param start: The beginning of the range to download.
     :param end: The end of the range to download.  If None, will be set equal to the start date,
     capturing one day of output.  Default None.
     :param download_dest: Where to save the downloaded file.  %P will be replaced with protocol name(s),
     %S with the start date, and %E with the end date.  Default "%P_%S_%E.json".
-    :param check_existing: Whether to check if the file exists locally (at download_dest) before
-    downloading.  download_dest will be interpreted according to the rules listed above before checking.
-    Default True.
+    :param check_existing: Whether to check if a complete file exists locally (at download_dest) before
+    downloading.  download_dest will be interpreted according to the rules listed above before checking.  See
+    download_is_complete().  Default True.
+    :param retries: The number of times to resume the download after a failure before giving up.  Client errors
+    (HTTP 4xx other than 408, 416 and 429) are not retried.  Default 3.
+    :param backoff: The number of seconds to wait before the first retry.  The wait doubles with each further retry.
+    Default 1.0.
     :returns: The path to the downloaded file, including the file name.
+    :raises IOError: If the download could not be completed.
     """
     if end is None:
         end = start
@@ -102,136 +249,863 @@ def download_from_api(protocols: List[str], start: Union[date, datetime], end: O
     download_dest = download_dest.replace("%S", start.strftime("%Y%m%d"))
     download_dest = download_dest.replace("%E", end.strftime("%Y%m%d"))
 
-    # Check if file already exists at the destination.  If a file by the target name already exists, skip download.
+    # Check if a complete file already exists at the destination.  If so, skip download.
     if check_existing:
-        if isfile(download_dest):
+        if download_is_complete(download_dest):
             print("--  Download will not be attempted as the file already exists locally.")
             return download_dest
+        elif isfile(download_dest):
+            print("--  The file that exists locally is incomplete and will be downloaded again.")
+
+    part_dest = download_dest + ".part"
+    validator_dest = part_dest + ".validator"
+    error = None
+
+    # Try to download from the API, resuming the partial file after each failure.
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            # The API builds its responses on request, so a partial file can only be continued if the server can
+            # confirm (through If-Range) that the data have not changed since it was started.
+            validator = None
+            if isfile(part_dest) and isfile(validator_dest):
+                with open(validator_dest, "r") as f:
+                    validator = json.load(f)
+            if validator is None:
+                _discard_partial_download(part_dest)
+            offset = getsize(part_dest) if isfile(part_dest) else 0
+
+            request = Request(download_src)
+            if offset > 0:
+                request.add_header("Range", "bytes={}-".format(offset))
+                for header, value in validator.items():
+                    request.add_header(header, value)
+                print("--  Resuming download from byte {}...".format(offset))
+            else:
+                print("--  Downloading from API...")
+            print("--  {}".format(download_src))
+
+            # Open the target URL, open the local file, and copy.
+            with closing(urlopen(request)) as r:
+                # If the server ignored the range request, or the data have changed, it is sending the whole file
+                # again.  A partial response must continue exactly where the partial file ends.
+                if offset > 0 and r.status != 206:
+                    offset = 0
+                elif offset > 0 and not (r.headers.get("Content-Range") or "").startswith("bytes {}-".format(offset)):
+                    _discard_partial_download(part_dest)
+                    raise IOError("The server resumed from the wrong place: '{}'."
+                                  .format(r.headers.get("Content-Range")))
+                if offset == 0:
+                    _discard_partial_download(part_dest)
+                    validator = _resume_validator(r.headers)
+                    if validator is not None:
+                        with open(validator_dest, "w") as f:
+                            json.dump(validator, f)
+
+                length = r.headers.get("Content-Length")
+                expected = offset + int(length) if length is not None else None
+                with open(part_dest, "ab" if offset > 0 else "wb") as f:
+                    copyfileobj(r, f)
+
+            received = getsize(part_dest)
+            if expected is not None and received != expected:
+                raise IOError("Connection closed after {} of {} bytes.".format(received, expected))
+            # Without a length to compare against, a connection that closed early looks like a finished one, so the
+            # end of the file itself is checked.
+            if expected is None and not _ends_like_feature_collection(part_dest):
+                raise IOError("Connection closed after {} bytes, before the end of the JSON.".format(received))
+
+            # Move the finished file into place, then record what a complete file looks like.
+            replace(part_dest, download_dest)
+            _discard_partial_download(part_dest)
+            with open(download_dest + ".meta", "w") as f:
+                json.dump(dict(source=download_src, bytes=received, sha256=file_sha256(download_dest)), f)
+
+            print("--  Download successful.  Saved to:")
+            print("--  {}".format(download_dest))
+            return download_dest
+
+        # In the event of a failure, print the error.
+        except Exception as e:
+            print("(x) Download failed:")
+            print(e)
+            error = e
+            if isinstance(e, HTTPError):
+                # A 416 means the server cannot satisfy the resume request; start over from scratch next time.
+                if e.code == 416:
+                    _discard_partial_download(part_dest)
+                # Other client errors will not go away by asking again.
+                elif 400 <= e.code < 500 and e.code not in [408, 429]:
+                    raise IOError("Download from '{}' failed with HTTP error {}.".format(download_src, e.code)) from e
+
+    raise IOError("Download from '{}' failed after {} attempt(s).".format(download_src, retries + 1)) from error
 
-    # Try to download from the API.
+
+def split_date_range(start: Union[date, datetime], end: Union[date, datetime],
+                     shard: str = "month") -> List[Tuple[Union[date, datetime], Union[date, datetime]]]:
+    """
+    Splits an inclusive date range into consecutive, non-overlapping inclusive windows.
+    :param start: The beginning of the range.
+    :param end: The end of the range (inclusive).
+    :param shard: The size of each window: 'day', 'week' (seven days counted from start) or 'month' (calendar months;
+    the first and last windows may be partial).  Default 'month'.
+    :return: A chronological list of (window start, window end) pairs that together cover the range exactly.
+    :raises ValueError: If shard is not 'day', 'week', or 'month', or if end is before start.
+    """
+    if shard not in ["day", "week", "month"]:
+        raise ValueError("Argument 'shard' must be either 'day', 'week', or 'month'.")
+    if end < start:
+        raise ValueError("Argument 'end' must not be before argument 'start'.")
+
+    windows = []
+    window_start = start
+    while window_start <= end:
+        if shard == "day":
+            window_end = window_start
+        elif shard == "week":
+            window_end = window_start + timedelta(days=6)
+        else:
+            # The last day of the month is the day before the first day of the next month.
+            next_month = (window_start.replace(day=1) + timedelta(days=32)).replace(day=1)
+            window_end = next_month - timedelta(days=1)
+        window_end = min(window_end, end)
+        windows.append((window_start, window_end))
+        window_start = window_end + timedelta(days=1)
+
+    return windows
+
+
+def download_sharded_from_api(protocols: List[str], start: Union[date, datetime], end: Union[date, datetime],
+                              shard: str = "month", workers: int = 4, download_dest: str = "%P_%S_%E.json",
+                              check_existing: bool = True) -> List[Tuple[Union[date, datetime], Union[date, datetime],
+                                                                         str]]:
+    """
+    Downloads a long date range from the GLOBE API as a set of smaller queries, several at a time.  Each query covers
+    one shard of the range (see split_date_range()) and is saved to its own file, so that no single query approaches
+    the API's limit of 1 million observations.
+    :param protocols: The protocols to download.
+    :param start: The beginning of the range to download.
+    :param end: The end of the range to download (inclusive).
+    :param shard: The size of each query: 'day', 'week', or 'month'.  Default 'month'.
+    :param workers: The maximum number of queries to run concurrently.  Default 4.
+    :param download_dest: Where to save each downloaded file.  %P will be replaced with protocol name(s), %S with the
+    start date of the shard, and %E with the end date of the shard.  Default "%P_%S_%E.json".
+    :param check_existing: Whether to skip shards whose files already exist locally.  Default True.
+    :return: The manifest of the download: a chronological list of (shard start, shard end, path) triples.  The path
+    is None for any shard that could not be downloaded; calling this function again will resume those shards.
+    :raises ValueError: If download_dest contains neither %S nor %E (every shard would be saved to the same file), or
+    if workers is less than 1.
+    """
+    if "%S" not in download_dest and "%E" not in download_dest:
+        raise ValueError("Argument 'download_dest' must contain %S or %E so that each shard has its own file.")
+    if workers < 1:
+        raise ValueError("Argument 'workers' must be at least 1.")
+
+    windows = split_date_range(start, end, shard)
+    print("--  Downloading {} shard(s) using {} worker(s)...".format(len(windows), min(workers, len(windows))))
+
+    def download_window(window):
+        try:
+            return download_from_api(protocols, window[0], window[1], download_dest=download_dest,
+                                     check_existing=check_existing)
+        except IOError:
+            return None
+
+    # The work is almost entirely waiting on the network, so threads are sufficient.
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        paths = list(pool.map(download_window, windows))
+
+    return [(w[0], w[1], path) for w, path in zip(windows, paths)]
+
+
+class _JSONStream:
+    """
+    A minimal incremental reader over a text file containing JSON.  Values are decoded one at a time with
+    json.JSONDecoder.raw_decode, and the file is read in chunks only as far as is needed to complete the current value.
+    """
+    def __init__(self, f, chunk_size: int = 65536):
+        self._f = f
+        self._chunk_size = chunk_size
+        # The decoder only shares equal keys between the objects of a single raw_decode call, and every feature is
+        # decoded by its own call.  Keys are therefore looked up in one dictionary kept for the whole file, so that all
+        # the observations share a single copy of each key, as they would after json.loads.
+        self._keys = dict()
+        self._decoder = json.JSONDecoder(object_pairs_hook=self._object)
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _object(self, pairs: List[Tuple[str, Any]]) -> dict:
+        """
+        Builds a decoded JSON object, replacing each key with the copy of it that was seen first.
+        :param pairs: The (key, value) pairs of the object, in order.
+        :return: The object.
+        """
+        keys = self._keys
+        return {keys.setdefault(k, k): v for k, v in pairs}
+
+    def _fill(self) -> bool:
+        """
+        Reads the next chunk of the file into the buffer, discarding whatever has already been consumed.
+        :return: Whether any more text was read.
+        """
+        if self._eof:
+            return False
+        chunk = self._f.read(self._chunk_size)
+        if chunk == "":
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def next_char(self) -> str:
+        """
+        Consumes whitespace and then one character.
+        :return: The first non-whitespace character, or "" if the end of the file was reached.
+        """
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in " \t\n\r":
+                self._pos += 1
+            if self._pos < len(self._buf):
+                self._pos += 1
+                return self._buf[self._pos - 1]
+            if not self._fill():
+                return ""
+
+    def peek_char(self) -> str:
+        """
+        Consumes whitespace, then returns the next character without consuming it.
+        :return: The first non-whitespace character, or "" if the end of the file was reached.
+        """
+        c = self.next_char()
+        if c != "":
+            self._pos -= 1
+        return c
+
+    def expect(self, char: str):
+        """
+        Consumes the next non-whitespace character, which must be char.
+        :param char: The character expected.
+        :raises ValueError: If any other character is found.
+        """
+        c = self.next_char()
+        if c != char:
+            raise ValueError("Malformed JSON: expected '{}' but found '{}'.".format(char, c))
+
+    def decode(self):
+        """
+        Decodes the next complete JSON value, reading further into the file as needed.
+        :return: The decoded value.
+        :raises json.JSONDecodeError: If the value is malformed or the file ends before the value is complete.
+        """
+        self.peek_char()
+        while True:
+            try:
+                val, end = self._decoder.raw_decode(self._buf, self._pos)
+                # A number or literal that runs up to the end of the buffer may continue into the next chunk.
+                if end < len(self._buf) or not self._fill():
+                    self._pos = end
+                    return val
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+
+
+def _project_feature(feature: dict, fields: Iterable[str], accepted: Dict[str, set]) -> dict:
+    """
+    Drops the properties of a feature that are not among the fields.  The geometry is left alone.
+    :param feature: The JSON feature, which is modified in place.
+    :param fields: The keys to keep, without protocol prefix.  'protocol' is always kept.
+    :param accepted: For each protocol prefix seen so far, the keys to keep with and without that prefix.  New prefixes
+    are added to it.
+    :return: The feature.
+    """
+    properties = feature["properties"]
+    prefix = properties["protocol"].replace("_", "")
     try:
-        print("--  Downloading from API...")
-        print("--  {}".format(download_src))
-        # Open the target URL, open the local file, and copy.
-        with closing(urlopen(download_src)) as r:
-            with open(download_dest, 'wb') as f:
-                copyfileobj(r, f)
-        print("--  Download successful.  Saved to:")
-        print("--  {}".format(download_dest))
-    # In the event of a failure, print the error.
-    except Exception as e:
-        print("(x) Download failed:")
-        print(e)
-
-    return download_dest
-
-
-def parse_json(fp: str, tqdm=tqdm) -> List[Observation]:
-    """
-    Parses a JSON file and returns its features converted to observations.
-    :param fp: The path to the JSON file.
+        keep = accepted[prefix]
+    except KeyError:
+        keep = accepted[prefix] = set(fields) | {prefix + f for f in fields} | {"protocol"}
+    feature["properties"] = {k: v for k, v in properties.items() if k in keep}
+    return feature
+
+
+def iter_json(fp: str, chunk_size: int = 65536, compact: bool = False,
+              fields: Optional[Iterable[str]] = None) -> Iterator[Observation]:
+    """
+    Lazily parses a JSON file, yielding its features converted to observations one at a time.  Only the feature being
+    decoded (plus one chunk of text) is held in memory, so very large API downloads can be processed in constant memory.
+    :param fp: The path to the JSON file.  The file is read as UTF-8.
+    :param chunk_size: The number of characters to read from the file at a time.  Default 65536.
+    :param compact: Whether to create CompactObservations, which use less memory.  Default False.
+    :param fields: The properties to keep, without protocol prefix (see observation.used_keys for those read by this
+    package); all others are dropped as each feature is decoded.  The protocol and location are always kept.  Default
+    None, which keeps every property.
+    :returns: A generator of observations, in the order in which the features appear in the file.
+    :raises ValueError: If the file is not a JSON object containing a 'features' array.
+    """
+    cls = CompactObservation if compact else Observation
+    if fields is not None:
+        fields = frozenset(fields)
+        accepted = dict()
+
+    with open(fp, "r", encoding="utf8") as f:
+        stream = _JSONStream(f, chunk_size)
+        stream.expect("{")
+        if stream.peek_char() == "}":
+            raise ValueError("The JSON file at '{}' has no 'features' array.".format(fp))
+
+        # Walk the top-level keys, discarding everything until 'features' is found.
+        while True:
+            key = stream.decode()
+            stream.expect(":")
+            if key == "features":
+                break
+            stream.decode()
+            c = stream.next_char()
+            if c == "}":
+                raise ValueError("The JSON file at '{}' has no 'features' array.".format(fp))
+            elif c != ",":
+                raise ValueError("Malformed JSON: expected ',' or '}}' but found '{}'.".format(c))
+
+        # Decode and yield each element of the features array in turn.
+        stream.expect("[")
+        if stream.peek_char() == "]":
+            return
+        while True:
+            feature = stream.decode()
+            if fields is not None:
+                feature = _project_feature(feature, fields, accepted)
+            yield cls(feature=feature)
+            c = stream.next_char()
+            if c == "]":
+                return
+            elif c != ",":
+                raise ValueError("Malformed JSON: expected ',' or ']' but found '{}'.".format(c))
+
+
+def _parse_one_json(args: Tuple[str, Optional[FrozenSet[str]]]) -> List[CompactObservation]:
+    """
+    Worker for parse_json().  This must be a module-level function so that it can be sent to other processes.
+    :param args: The path to the JSON file and the fields to keep.
+    :return: The observations of the file.
+    """
+    fp, fields = args
+    return parse_json(fp, compact=True, fields=fields, tqdm=_no_progress)
+
+
+def parse_json(fp: Union[str, List[str]], compact: bool = False, fields: Optional[Iterable[str]] = None,
+               workers: int = 1, tqdm=tqdm) -> List[Observation]:
+    """
+    Parses a JSON file and returns its features converted to observations.  See iter_json() to process the features one
+    at a time instead.
+    :param fp: The path to the JSON file, or a list of paths (such as the shards listed in the manifest returned by
+    download_sharded_from_api()), whose observations will be joined in order.
+    :param compact: Whether to create CompactObservations, which use less memory.  Default False.
+    :param fields: The properties to keep (see iter_json()).  Default None, which keeps every property.
+    :param workers: The number of processes across which to spread the files, if fp is a list.  Each worker parses
+    whole files and sends back CompactObservations (whatever compact is), which are far cheaper to transfer between
+    processes than Observations.  Default 1, which parses everything in this process.
+    :param tqdm: The wrapper around for-loops in this function.  Default tqdm, which will print a progress bar.
     :returns: The features of the JSON.
+    :raises ValueError: If workers is less than 1, or greater than 1 when fp is a single path (a single file cannot be
+    split between processes; see download_sharded_from_api()).
     """
+    if workers < 1:
+        raise ValueError("Argument 'workers' must be at least 1.")
+
+    if type(fp) is not str:
+        if workers == 1:
+            return [ob for f in fp for ob in parse_json(f, compact, fields, tqdm=tqdm)]
+        fields = None if fields is None else frozenset(fields)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(tqdm(pool.map(_parse_one_json, [(f, fields) for f in fp]), total=len(fp),
+                              desc="Parsing JSON files"))
+        return [ob for part in parts for ob in part]
+
+    if workers > 1:
+        raise ValueError("Argument 'workers' must be 1 when 'fp' is a single file; pass a list of shards to parse "
+                         "them in parallel.")
+
     print("--  Reading JSON from {}...".format(fp))
+    return [ob for ob in tqdm(iter_json(fp, compact=compact, fields=fields), desc="Parsing JSON as observations")]
+
+
+# Bump this whenever the layout of the columns produced by observations_to_columns() changes, so that old caches are
+# rebuilt rather than misread.
+_columns_version = 3
+
+# Columns that are not cached.  Observations have no flags until they are quality checked, which happens after they
+# are parsed, so a cache written while parsing would only ever hold empty flags.
+_uncached_columns = ("flags", "flag_mask")
+
+def source_checksum(fp: str) -> str:
+    """
+    Gets the SHA-256 checksum of a file, using the sidecar written by download_from_api() if it is present and agrees
+    with the size of the file, and hashing the file otherwise.
+    :param fp: The path to the file.
+    :return: The hexadecimal digest.
+    """
     try:
-        with open(fp, "r") as f:
-            g = f.read()
-            print("--  Interpreting file as JSON...")
-            raw = json.loads(g)
-    except UnicodeDecodeError:
-        with open(fp, "r", encoding="utf8") as f:
-            g = f.read()
-            print("--  Interpreting file as JSON...")
-            raw = json.loads(g)
+        with open(fp + ".meta", "r") as f:
+            meta = json.load(f)
+        if meta["bytes"] == getsize(fp):
+            return meta["sha256"]
+    except (IOError, ValueError, KeyError):
+        pass
+    return file_sha256(fp)
+
+
+def columns_cache_path(fp: str, cache_dir: Optional[str] = None) -> str:
+    """
+    Gets the path of the column cache for a source file.  Since downloads are named for their protocols and dates (see
+    download_from_api()), so are their caches.
+    :param fp: The path to the source file.
+    :param cache_dir: The folder in which caches are kept.  Default None, which uses the folder of the source file.
+    :return: The path to the cache.
+    """
+    return join(dirname(fp) if cache_dir is None else cache_dir, splitext(basename(fp))[0] + ".columns.npz")
+
+
+def save_columns(columns: Dict[str, np.ndarray], fp: str, cache_dir: Optional[str] = None) -> str:
+    """
+    Saves columns (see observations_to_columns()) to the cache for the given source file.  The flags are not saved.
+    :param columns: The columns to save.
+    :param fp: The path to the source file that the columns were parsed from.
+    :param cache_dir: The folder in which caches are kept.  Default None, which uses the folder of the source file.
+    :return: The path to the cache.
+    """
+    cache_fp = columns_cache_path(fp, cache_dir)
+    # The size and modification time of the source let later loads skip hashing it while it is unchanged.
+    stat_result = stat(fp)
+    savez_atomic(cache_fp, _version=np.array(_columns_version), _source_sha256=np.array(source_checksum(fp)),
+                 _source_bytes=np.array(stat_result.st_size), _source_mtime_ns=np.array(stat_result.st_mtime_ns),
+                 **{key: column for key, column in columns.items() if key not in _uncached_columns})
+    return cache_fp
+
+
+def load_columns(fp: str, cache_dir: Optional[str] = None) -> Optional[Dict[str, np.ndarray]]:
+    """
+    Loads the cached columns for the given source file.
+    :param fp: The path to the source file.
+    :param cache_dir: The folder in which caches are kept.  Default None, which uses the folder of the source file.
+    :return: The columns, or None if there is no cache, or if the cache is out of date (the source file has changed or
+    the cache was written by an incompatible version of this code).  The source file is only hashed if its size or
+    modification time differ from when the cache was saved.  The flags column is empty, as for freshly parsed
+    observations.
+    """
+    cache_fp = columns_cache_path(fp, cache_dir)
+    if not isfile(cache_fp):
+        return None
+
+    with np.load(cache_fp) as cache:
+        if int(cache["_version"]) != _columns_version:
+            return None
+        stat_result = stat(fp)
+        unchanged = (int(cache["_source_bytes"]) == stat_result.st_size and
+                     int(cache["_source_mtime_ns"]) == stat_result.st_mtime_ns)
+        if not unchanged and str(cache["_source_sha256"]) != source_checksum(fp):
+            return None
+        columns = {key: cache[key] for key in cache.files if not key.startswith("_")}
+    # The source was touched but not changed; record its new modification time so that it is not hashed again.
+    if not unchanged:
+        save_columns(columns, fp, cache_dir)
+    columns["flags"] = np.full(len(columns["protocol"]), "", dtype=str)
+    return columns
+
+
+def concatenate_columns(columns_list: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    """
+    Joins several sets of columns (see observations_to_columns()) end to end.
+    :param columns_list: The sets of columns, in order.
+    :return: The combined columns.  If columns_list is empty, the columns are empty.
+    """
+    if len(columns_list) == 0:
+        return observations_to_columns([], tqdm=_no_progress)
+    return {key: np.concatenate([columns[key] for columns in columns_list]) for key in columns_list[0]}
 
-    ret = []
-    for o in tqdm(range(len(raw["features"])), desc="Parsing JSON as observations"):
-        ob = raw["features"][o]
-        ret.append(Observation(feature=ob))
-    return ret
 
-    # Although this works and may be more efficient, I'm not sure how to make it work with tqdm...
-    # return [Observation(feature=ob) for ob in raw["features"]]
+def _no_progress(iterable, *_, **__):
+    """
+    A stand-in for tqdm that prints nothing, for use in worker processes.
+    """
+    return iterable
+
+
+def _parse_one_json_columns(args: Tuple[str, Optional[str]]) -> Dict[str, np.ndarray]:
+    """
+    Worker for parse_json_columns().  This must be a module-level function so that it can be sent to other processes.
+    :param args: The path to the JSON file and the cache folder.
+    :return: The columns of the file.
+    """
+    fp, cache_dir = args
+    return parse_json_columns(fp, cache_dir=cache_dir, tqdm=_no_progress)
 
 
-def get_flag_counts(obs: List[Observation]) -> Dict[str, int]:
+def parse_json_columns(fp: Union[str, List[str]], cache_dir: Optional[str] = None, workers: int = 1,
+                       tqdm=tqdm) -> Dict[str, np.ndarray]:
+    """
+    Gets the columns (see observations_to_columns()) of a JSON file, from the cache if it is up to date, or else by
+    parsing the file and then caching the result.
+    :param fp: The path to the JSON file, or a list of paths (such as the shards listed in the manifest returned by
+    download_sharded_from_api()), whose columns will be joined in order.
+    :param cache_dir: The folder in which caches are kept.  Default None, which uses the folder of each JSON file.
+    :param workers: The number of processes across which to spread the files.  Each worker parses (or loads from cache)
+    whole files and sends back only their columns, which are far cheaper to transfer between processes than
+    observations.  Default 1, which parses everything in this process.
+    :param tqdm: The wrapper around for-loops in this function.  Default tqdm, which will print a progress bar.
+    :return: The columns.  The observations are not quality checked, so the flags column is empty.
+    :raises ValueError: If workers is less than 1, or greater than 1 when fp is a single path.
+    """
+    if workers < 1:
+        raise ValueError("Argument 'workers' must be at least 1.")
+
+    if type(fp) is str and workers > 1:
+        raise ValueError("Argument 'workers' must be 1 when 'fp' is a single file; pass a list of shards to parse "
+                         "them in parallel.")
+
+    if type(fp) is not str:
+        if workers == 1:
+            return concatenate_columns([parse_json_columns(f, cache_dir, tqdm=tqdm) for f in fp])
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return concatenate_columns(list(tqdm(pool.map(_parse_one_json_columns, [(f, cache_dir) for f in fp]),
+                                                 total=len(fp), desc="Parsing JSON files")))
+
+    columns = load_columns(fp, cache_dir)
+    if columns is not None:
+        print("--  Loaded cached columns for {}.".format(fp))
+        return columns
+
+    print("--  Reading JSON from {}...".format(fp))
+    # The columns only need the keys that this package reads.
+    columns = observations_to_columns(iter_json(fp, fields=used_keys), tqdm=tqdm)
+    save_columns(columns, fp, cache_dir)
+    return columns
+
+
+# Positions of the digits and separators in a datetime string formatted as %Y-%m-%dT%H:%M:%S.
+_datetime_digits = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+_datetime_separators = {4: "-", 7: "-", 10: "T", 13: ":", 16: ":"}
+
+# The number of days in each month (index 1 to 12) of a year that is not a leap year.
+_days_in_month = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+
+def parse_datetimes(strings: Iterable[Optional[str]]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Converts many measurement datetime strings at once, with the same results as Observation.parse_measured_dt().
+    Strings in the canonical layout (%Y-%m-%dT%H:%M:%S, optionally with 1 to 6 digits of fractional seconds) are
+    checked and converted as whole arrays; anything else is converted one string at a time.
+    :param strings: The strings.  None indicates a missing datetime.
+    :return: The datetimes as a datetime64[us] array (NaT where missing or invalid), and an array of the flag that each
+    string raises: "DX" if it is missing, "DI" if it is malformed or not a real datetime, or "" if it is valid.
+    """
+    strings = list(strings)
+    n = len(strings)
+    ret = np.full(n, np.datetime64("NaT"), dtype="datetime64[us]")
+    flags = np.full(n, "", dtype="<U2")
+    if n == 0:
+        return ret, flags
+
+    is_missing = np.fromiter((s is None for s in strings), dtype=bool, count=n)
+    is_str = np.fromiter((type(s) is str for s in strings), dtype=bool, count=n)
+    flags[is_missing] = "DX"
+    done = is_missing.copy()
+
+    text = np.array([s if type(s) is str else "" for s in strings], dtype=str)
+    lengths = np.char.str_len(text)
+    candidates = np.flatnonzero(is_str & ((lengths == 19) | ((lengths >= 21) & (lengths <= 26))))
+
+    if len(candidates) > 0:
+        # View each string as a row of 26 code points.
+        fixed = text[candidates].astype("<U26")
+        codes = fixed.view(np.uint32).reshape(-1, 26).astype(np.int64)
+        length = lengths[candidates]
+        digits = (codes >= ord("0")) & (codes <= ord("9"))
+
+        ok = digits[:, _datetime_digits].all(axis=1)
+        for position, separator in _datetime_separators.items():
+            ok &= codes[:, position] == ord(separator)
+        # Fractional seconds: a '.' followed by digits up to the end of the string.
+        fractional = length > 19
+        ok &= ~fractional | (codes[:, 19] == ord("."))
+        for position in range(20, 26):
+            ok &= ~(position < length) | digits[:, position]
+
+        # Reject out-of-range fields here; numpy would otherwise refuse the whole array.
+        def field(start, width):
+            val = np.zeros(len(codes), dtype=np.int64)
+            for position in range(start, start + width):
+                val = val * 10 + codes[:, position] - ord("0")
+            return val
+        year, month, day = field(0, 4), field(5, 2), field(8, 2)
+        ok &= (year >= 1) & (month >= 1) & (month <= 12)
+        # The day must exist in its month (e.g. not 30 February), allowing for leap years.
+        leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+        ok &= (day >= 1) & (day <= _days_in_month[np.clip(month, 0, 12)] + ((month == 2) & leap))
+        ok &= (field(11, 2) <= 23) & (field(14, 2) <= 59) & (field(17, 2) <= 59)
+
+        good = candidates[ok]
+        ret[good] = fixed[ok].astype("datetime64[us]")
+        done[good] = True
+
+    # Anything left over gets the exact, one-at-a-time treatment.
+    for i in np.flatnonzero(~done):
+        dt = Observation.parse_measured_dt(strings[i])
+        if dt is None:
+            flags[i] = "DI"
+        else:
+            ret[i] = dt
+
+    return ret, flags
+
+
+def measured_datetimes(obs: List[Observation]) -> np.ndarray:
+    """
+    Gets the measurement datetimes of many observations at once (see parse_datetimes()).  As with
+    Observation.measured_dt, flags DX and DI are raised where appropriate, and each observation remembers its datetime
+    so that later uses of measured_dt do not parse it again.
+    :param obs: The observations.
+    :return: The datetimes as a datetime64[us] array, with NaT where the datetime is missing or invalid.
+    """
+    values, flags = parse_datetimes(ob.measured_dt_string for ob in obs)
+    for ob, val, flag in zip(obs, values.astype(object), flags.tolist()):
+        ob._remember("measured_dt", val, (flag,) if flag else ())
+        ob.flag(flag or None)
+    return values
+
+
+def flag_masks(obs: Union[List[Observation], ObservationTable]) -> np.ndarray:
+    """
+    Gets the flags of each observation as a bitmask (see observation.flag_bit()).
+    :param obs: The observations, or an ObservationTable (whose 'flag_mask' column is returned).
+    :return: An array of one uint64 bitmask per observation.
+    """
+    if isinstance(obs, ObservationTable):
+        return obs["flag_mask"]
+    return np.fromiter((flags_to_mask(ob.flags) for ob in obs), dtype=np.uint64, count=len(obs))
+
+
+def get_flag_counts(obs: Union[List[Observation], ObservationTable],
+                    masks: Optional[np.ndarray] = None) -> Dict[str, int]:
     """
     Gets a summary of all flags for the given observations.
-    :param obs: The observations to analyze.
+    :param obs: The observations to analyze, or an ObservationTable.
+    :param masks: The flag bitmasks of the observations, if already known (see flag_masks()).  Default None, which
+    computes them.
     :return: The dictionary of (flag, count) pairs for each flag found at least once.
     """
-    flag_counts = dict()
     print("--  Enumerating flags...")
+    if masks is None:
+        masks = flag_masks(obs)
+
+    flag_counts = dict()
     # tqdm not used here because this is a surprisingly fast process.
-    for ob in obs:
-        for flag in ob.flags:
-            try:
-                flag_counts[flag] += 1
-            except KeyError:
-                flag_counts[flag] = 1
+    for flag, bit in list(flag_bits.items()):
+        count = int(np.count_nonzero(masks & np.uint64(bit)))
+        if count > 0:
+            flag_counts[flag] = count
 
     return flag_counts
 
 
-def filter_by_flag(obs: List[Observation], specs: Union[bool, Dict[str, bool]] = True, tqdm=tqdm) -> List[Observation]:
+def crosstab_flags(obs: Union[List[Observation], ObservationTable], by: Iterable[str] = ("protocol",),
+                   masks: Optional[np.ndarray] = None) -> Tuple[List[str], List[List[Optional[str]]], np.ndarray]:
+    """
+    Counts how many observations have each flag, broken down by the values of one or more attributes, in a single
+    pass over the observations.
+    :param obs: The observations to analyze, or an ObservationTable (in which case the attributes must be columns).
+    :param by: The attributes to break the counts down by, e.g. ["protocol", "DataSource"].  Default ("protocol",).
+    :param masks: The flag bitmasks of the observations, if already known (see flag_masks()).  Default None, which
+    computes them.
+    :return: The flags found at least once; for each attribute, its values (as strings, sorted, followed by None if
+    some observations do not have the attribute); and an array of counts with one axis for the flags and one for each
+    attribute, in the same orders.  For instance, counts[i, j] is the number of observations with flag flags[i] and
+    value levels[0][j] of the first attribute.
+    """
+    by = list(by)
+    if masks is None:
+        masks = flag_masks(obs)
+    if isinstance(obs, ObservationTable):
+        columns = {key: obs[key] for key in by}
+    else:
+        columns = _key_columns(obs, {key: [key] for key in by})
+
+    # Number the values of each attribute, and combine the numbers into one position per observation.
+    levels = []
+    codes = []
+    for key in by:
+        column = np.asarray(columns[key])
+        missing = np.equal(column, None) if column.dtype == object else np.zeros(len(column), dtype=bool)
+        values, inverse = np.unique(column[~missing].astype(str), return_inverse=True)
+        code = np.full(len(column), len(values), dtype=np.intp)
+        code[~missing] = inverse.ravel()
+        levels.append(values.tolist() + ([None] if missing.any() else []))
+        codes.append(code)
+    shape = tuple(len(level) for level in levels)
+    cells = np.ravel_multi_index(codes, shape) if len(by) > 0 else np.zeros(len(masks), dtype=np.intp)
+
+    flags = []
+    counts = []
+    for flag, bit in list(flag_bits.items()):
+        has_flag = (masks & np.uint64(bit)) != 0
+        if has_flag.any():
+            flags.append(flag)
+            counts.append(np.bincount(cells[has_flag], minlength=int(np.prod(shape))).reshape(shape))
+
+    return flags, levels, np.array(counts, dtype=np.int64).reshape((len(flags),) + shape)
+
+
+def partition(obs: Union[List[Observation], ObservationTable],
+              keys: Iterable[str] = ("protocol", "DataSource")) -> Partition:
+    """
+    Groups observations by the values of some of their attributes, in one pass.  Subsets such as "sky conditions
+    observations from the GLOBE Observer app" can then be picked from the Partition (see Partition.select()) without
+    looking at every observation again.
+    :param obs: The observations, or an ObservationTable (in which case the attributes must be columns).
+    :param keys: The attributes to group by.  Any key can be used for observations, including CompactObservations,
+    whose keys outside observation.used_keys are decoded on request.  Default ("protocol", "DataSource").
+    :return: The Partition.
+    :raises ValueError: If obs is an ObservationTable and one of the attributes is not one of its columns.
+    """
+    keys = list(keys)
+    if isinstance(obs, ObservationTable):
+        for key in keys:
+            if key not in obs.columns:
+                raise ValueError("Argument 'keys' must only contain columns of the table, not '{}'.".format(key))
+        columns = {key: obs[key] for key in keys}
+    else:
+        columns = _key_columns(obs, {key: [key] for key in keys})
+    return Partition(obs, keys, columns)
+
+
+def flag_index(obs: Union[List[Observation], ObservationTable],
+               masks: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+    """
+    Builds an inverted index of the flags of the observations, which lets filter_by_flag() and filter_by_flag_sets()
+    answer without looking at every observation.  Build it once quality checking is done; it does not follow any later
+    change to the flags.
+    :param obs: The observations, or an ObservationTable.
+    :param masks: The flag bitmasks of the observations, if already known (see flag_masks()).  Default None, which
+    computes them.
+    :return: For each flag raised on at least one observation, the positions of the observations that have it, in
+    ascending order.
+    """
+    if masks is None:
+        masks = flag_masks(obs)
+
+    index = dict()
+    for flag, bit in flag_bits.items():
+        positions = np.flatnonzero(masks & np.uint64(bit))
+        if len(positions) > 0:
+            index[flag] = positions
+    return index
+
+
+def _select(obs: Union[List[Observation], ObservationTable],
+            positions: np.ndarray) -> Union[List[Observation], ObservationTable]:
+    """
+    :return: The observations at the given positions, as a list or (if obs is an ObservationTable) a table.
+    """
+    if isinstance(obs, ObservationTable):
+        return obs.where(positions)
+    return [obs[i] for i in positions]
+
+
+def filter_by_flag(obs: Union[List[Observation], ObservationTable], specs: Union[bool, Dict[str, bool]] = True,
+                   tqdm=tqdm,
+                   index: Optional[Dict[str, np.ndarray]] = None) -> Union[List[Observation], ObservationTable]:
     """
     Filters a list of observations by whether it has particular flags.
-    :param obs: The observations to filter.
+    :param obs: The observations to filter, or an ObservationTable (in which case a table is returned).
     :param specs: The flag specifications that an observation must meet to be included in the return.  This can be a
     dictionary of str-bool pairs, which indicates which flags must be present or absent for an observation to pass.
     For instance, {"DX"=True, "ER"=False} means that the observation must have the DX flag and must not have the ER
     flag.  Alternatively, specs can be True, meaning that at least one flag must be present, or False, meaning that all
     flags must be absent.  Default True.
-    :param tqdm: The wrapper around for-loops in this function.  Default tqdm, which will print a progress bar.
-    :return: The filtered observations.
+    :param tqdm: Unused; kept for compatibility.
+    :param index: The inverted index of the flags of the observations, if already built (see flag_index()).  Default
+    None, which filters by looking at every observation.
+    :return: The filtered observations, each at most once.
     :raises TypeError: If specs is neither a string or a dict of string=bool pairs.
     """
-    # If specs is a dict...
+    # If specs is a dict, every specification k=v must be met: k is the flag and v is whether it must be present or
+    # absent.
     if type(specs) == dict:
-        ret = []
-        # For each observation...
-        for ob in tqdm(obs, desc="Filtering observations by flag"):
-            # For each specification k=v, k is the flag and v is whether it must be present or absent.
-            for k, v in specs.items():
-                # If the flag is present or absent as required, add this ob to the list.
-                if ob.has_flag(k) == v:
-                    ret.append(ob)
-        return ret
-    # If specs is a bool, just return those obs which have or do not have flags.
-    elif type(specs) == bool:
-        return [ob for ob in obs if ob.flagged == specs]
+        return filter_by_flag_sets(obs, all_of=[k for k, v in specs.items() if v],
+                                   none_of=[k for k, v in specs.items() if not v], index=index)
     # If not a dict or bool, raise an error.
-    else:
+    elif type(specs) != bool:
         raise TypeError("Argument 'specs' must be either Dict[str, bool] or bool.")
 
+    # If specs is a bool, just return those obs which have or do not have flags.
+    if index is not None:
+        flagged = np.unique(np.concatenate([np.empty(0, dtype=np.intp)] + list(index.values())))
+        return _select(obs, flagged if specs else np.setdiff1d(np.arange(len(obs)), flagged, assume_unique=True))
+    elif isinstance(obs, ObservationTable):
+        return obs.where((obs["flag_mask"] != 0) == specs)
+    else:
+        return [ob for ob in obs if ob.flagged == specs]
 
-def filter_by_flag_sets(obs: List[Observation], all_of: Iterable[str] = (), none_of: Iterable[str] = (),
-                        any_of: Iterable[str] = ()) -> List[Observation]:
+
+def filter_by_flag_sets(obs: Union[List[Observation], ObservationTable], all_of: Iterable[str] = (),
+                        none_of: Iterable[str] = (), any_of: Iterable[str] = (),
+                        masks: Optional[np.ndarray] = None,
+                        index: Optional[Dict[str, np.ndarray]] = None) -> Union[List[Observation], ObservationTable]:
     """
     Filters observations by whether they have or do not have certain combinations of flags.
-    :param obs: The observations to assess.
+    :param obs: The observations to assess, or an ObservationTable (in which case a table is returned).
     :param all_of: A list of flags that must all be present for an observation to pass.  Default (), which passes all
     observations.
     :param none_of: A list of flags that must all be absent for an observation to pass.  Default (), which passes all
     observations.
     :param any_of: A list of flags of which one must be present for an observation to pass.  Default (), which passes
     all observations.  Passing only one flag to any_of has the same effect as instead appending that flag to all_of.
+    :param masks: The flag bitmasks of the observations, if already known (see flag_masks()).  Default None, which
+    computes them.  Ignored if index is given.
+    :param index: The inverted index of the flags of the observations, if already built (see flag_index()).  The
+    observations that pass are then found from the positions in the index alone.  Default None.
     :return: An iterable of obs that have been filtered.
     """
-    # Store only those obs which have at least one flag from any_of - that is, the intersection of actual flags and
-    # required flags has at least one item.
-    # Note that we must skip this check of any_of is empty - otherwise, nothing passes.
-    ret = [ob for ob in obs if len(set(ob.flags) & set(any_of)) > 0] if any_of else [ob for ob in obs]
+    all_of, none_of, any_of = list(all_of), list(none_of), list(any_of)
+
+    if index is not None:
+        none = np.empty(0, dtype=np.intp)
+        # Start from the smallest set of positions that the answer must be drawn from, then narrow it down.
+        if len(all_of) > 0:
+            postings = sorted((index.get(flag, none) for flag in all_of), key=len)
+            positions = postings[0]
+            for posting in postings[1:]:
+                positions = np.intersect1d(positions, posting, assume_unique=True)
+        elif len(any_of) > 0:
+            positions = np.unique(np.concatenate([index.get(flag, none) for flag in any_of]))
+        else:
+            positions = np.arange(len(obs))
+
+        if len(all_of) > 0 and len(any_of) > 0:
+            positions = positions[np.isin(positions, np.concatenate([index.get(flag, none) for flag in any_of]))]
+        for flag in none_of:
+            positions = np.setdiff1d(positions, index.get(flag, none), assume_unique=True)
+        return _select(obs, positions)
+
+    if masks is None:
+        masks = flag_masks(obs)
 
-    # Store only those obs which have all of the all_of flags - that is, the actual flags is a (not necessarily proper)
-    # superset of the required flags.
-    ret = [ob for ob in ret if set(ob.flags) >= set(all_of)]
+    all_mask = np.uint64(flags_to_mask(all_of))
+    none_mask = np.uint64(flags_to_mask(none_of))
+    any_mask = np.uint64(flags_to_mask(any_of))
 
-    # Store only those obs which have none of the none_of flags - that is, the intersection of actual flags and required
-    # flags is empty.
-    ret = [ob for ob in ret if len(set(ob.flags) & set(none_of)) == 0]
+    # Pass only those obs which have all of the all_of flags and none of the none_of flags.
+    keep = ((masks & all_mask) == all_mask) & ((masks & none_mask) == 0)
+
+    # Pass only those obs which have at least one flag from any_of.
+    # Note that we must skip this check of any_of is empty - otherwise, nothing passes.
+    if any_mask:
+        keep &= (masks & any_mask) != 0
 
-    return ret
+    return _select(obs, np.flatnonzero(keep))
 
 
 def get_cdf_datetime(cdf: Dataset, index: int) -> datetime:
@@ -294,73 +1168,476 @@ def find_closest_gridbox(cdf: Dataset, t: datetime, lat: float, lon: float) -> T
     return int(time_index), int(lat_index), int(lon_index)
 
 
-def prepare_earth_geometry(geometry_resolution: str = "50m"):
+# The land geometry of each resolution, once prepared in this process (see prepare_earth_geometry()).
+_earth_geometry = dict()
+
+# Bump this whenever the way the land geometry is made changes, so that old caches on disk are remade.
+_earth_geometry_version = 1
+
+
+def earth_geometry_cache_path(geometry_resolution: str, cache_dir: Optional[str] = None) -> str:
+    """
+    Gets the path of the cache of the unioned land geometry (see prepare_earth_geometry()).
+    :param geometry_resolution: The resolution of the NaturalEarth geometry.
+    :param cache_dir: The folder in which caches are kept.  Default None, which uses cartopy's data folder (where the
+    NaturalEarth files are also kept).
+    :return: The path to the cache.
+    """
+    return join(cartopy.config["data_dir"] if cache_dir is None else cache_dir,
+                "natural_earth_land_{}.npz".format(geometry_resolution))
+
+
+def prepare_earth_geometry(geometry_resolution: str = "50m", cache_dir: Optional[str] = None):
     """
     Preparations necessary for determining whether a point is over land or water.
     This code may need to download a ZIP containing Earth geometry data the first time it runs.
     Code borrowed from   https://stackoverflow.com/a/48062502
+    Merging the land polygons into one geometry is slow, so the merged geometry is saved to disk (see
+    earth_geometry_cache_path()) and reused until the NaturalEarth file changes, and the prepared geometry is kept for
+    the rest of the process, so that later calls return the same object at once.
     :param geometry_resolution: The resolution of the NaturalEarth shapereader to use.  Valid values are '10m', '50m'
     or '110m'.  Default '50m'.
+    :param cache_dir: The folder in which caches are kept.  Default None, which uses cartopy's data folder.
     :return: The PreparedGeometry object that can be used for point-land checking.
     :raises ValueError: If geometry_resolution is not '10m', '50m', or '110m'.
     """
     if geometry_resolution not in ["10m", "50m", "110m"]:
         raise ValueError("Argument 'geometry_resolution' must be either '10m', '50m', or '110m'.")
 
+    if geometry_resolution in _earth_geometry:
+        return _earth_geometry[geometry_resolution]
+
     print("--  Preparing Earth geometry...")
     land_shp_fname = shpreader.natural_earth(resolution=geometry_resolution, category='physical', name='land')
-    land_geom = unary_union(list(shpreader.Reader(land_shp_fname).geometries()))
-    land = prep(land_geom)
+    source_sha256 = file_sha256(land_shp_fname)
+    cache_fp = earth_geometry_cache_path(geometry_resolution, cache_dir)
+
+    # Use the merged geometry from the cache if it was made from this same file.
+    land_geom = None
+    if isfile(cache_fp):
+        with np.load(cache_fp) as cache:
+            if int(cache["_version"]) == _earth_geometry_version and str(cache["_source_sha256"]) == source_sha256:
+                land_geom = shapely.wkb.loads(cache["wkb"].tobytes())
+
+    if land_geom is None:
+        land_geom = unary_union(list(shpreader.Reader(land_shp_fname).geometries()))
+        savez_atomic(cache_fp, _version=np.array(_earth_geometry_version), _source_sha256=np.array(source_sha256),
+                     wkb=np.frombuffer(land_geom.wkb, dtype=np.uint8))
+
+    land = _earth_geometry[geometry_resolution] = prep(land_geom)
     print("--  Earth geometry prepared.")
     return land
 
 
-def do_quality_check(obs: List[Observation], land=None, tqdm=tqdm):
+def prepare_land_mask(geometry_resolution: str = "50m", cell_size: float = 0.5,
+                      cache_dir: Optional[str] = None) -> LandMask:
+    """
+    Prepares a LandMask, which determines whether points are over land with the same result as the PreparedGeometry
+    from prepare_earth_geometry(), but much faster.  The raster of the mask is built the first time and then saved.
+    :param geometry_resolution: The resolution of the NaturalEarth shapereader to use.  Valid values are '10m', '50m'
+    or '110m'.  Default '50m'.
+    :param cell_size: The size of each cell of the raster, in degrees.  Default 0.5.
+    :param cache_dir: The folder in which rasters are kept.  Default None, which uses cartopy's data folder.
+    :return: The LandMask, which can be used for land checking wherever the PreparedGeometry can.
+    :raises ValueError: If geometry_resolution is not '10m', '50m', or '110m', or cell_size is not positive.
+    """
+    return LandMask(prepare_earth_geometry(geometry_resolution, cache_dir), cell_size=cell_size, cache_dir=cache_dir)
+
+
+def points_on_land(land, lon: Iterable[float], lat: Iterable[float]) -> np.ndarray:
+    """
+    Determines whether many points are over land at once, with the same result as land.contains(Point(lon, lat)) for
+    each point.
+    :param land: The LandMask (see prepare_land_mask()), the PreparedGeometry (see prepare_earth_geometry()), or an
+    unprepared geometry.
+    :param lon: The longitude of each point.
+    :param lat: The latitude of each point.
+    :return: A boolean array of whether each point is over land.  Points with a NaN coordinate are not over land.
+    """
+    if isinstance(land, LandMask):
+        return land.contains_xy(lon, lat)
+    geometry = getattr(land, "context", land)
+    return np.asarray(contains_xy(geometry, np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)),
+                      dtype=bool)
+
+
+def do_quality_check(obs: List[Observation], land=None, vectorized: bool = True, results_fp: Optional[str] = None,
+                     tqdm=tqdm):
     """
     Perform quality checks on the observations.
     :param obs: The observations.
-    :param land: The PreparedGeometry for land checking.  If None, land check will not be performed.
+    :param land: The PreparedGeometry or LandMask (see prepare_land_mask()) for land checking.  If None, land check
+    will not be performed.
+    :param vectorized: Whether to evaluate each check over all the observations at once (see
+    quality_check_flags()) rather than calling Observation.check_for_flags() on each one.  The flags raised are the same
+    either way.  Default True.
+    :param results_fp: The path to a file in which the flags raised on each observation are kept (see
+    save_quality_check_results()).  Observations found in the file unchanged since they were checked are not checked
+    again; their flags are raised from the file instead.  The file is then updated with the observations that were
+    checked.  Default None, in which case every observation is checked and nothing is kept.
     :param tqdm: The wrapper around for-loops in this function.  Default tqdm, which will print a progress bar.
+    :raises ValueError: If results_fp is given but vectorized is False.
+    """
+    if not vectorized:
+        if results_fp is not None:
+            raise ValueError("Argument 'results_fp' can only be used if 'vectorized' is True.")
+        for o in tqdm(range(len(obs)), desc="Performing quality check"):
+            obs[o].check_for_flags(land)
+        return
+
+    obs = list(obs)
+    columns = _key_columns(obs, _qc_key_lists)
+
+    # Sort the observations into those whose flags are known and those that need checking.
+    known = []
+    if results_fp is None:
+        unknown = list(range(len(obs)))
+    else:
+        results = load_quality_check_results(results_fp, land)
+        ids = [None if ob.id is None else str(ob.id) for ob in obs]
+        hashes = quality_check_hashes(columns)
+        unknown = []
+        for i, (ob_id, ob_hash) in enumerate(zip(ids, hashes)):
+            result = results.get(ob_id)
+            # DF depends on when the check is made, so an observation in the future must be checked again.
+            if result is not None and result[0] == ob_hash and "DF" not in result[1]:
+                known.append(i)
+            else:
+                unknown.append(i)
+        print("--  {} of {} observations unchanged since their last quality check.".format(len(known), len(obs)))
+
+    codes, raised = _quality_check_columns({name: column[unknown] for name, column in columns.items()}, land)
+
+    # np.nonzero() goes row by row, so each observation gets its flags in the order that check_for_flags() would raise
+    # them.
+    new_flags = [[] for _ in unknown]
+    rows, cols = np.nonzero(raised)
+    for row, col in zip(rows.tolist(), cols.tolist()):
+        if codes[col] not in new_flags[row]:
+            new_flags[row].append(codes[col])
+
+    for row, i in enumerate(tqdm(unknown, desc="Performing quality check")):
+        for flag in new_flags[row]:
+            obs[i].flag(flag)
+        if results_fp is not None and ids[i] is not None:
+            results[ids[i]] = (hashes[i], tuple(new_flags[row]))
+    for i in known:
+        for flag in results[ids[i]][1]:
+            obs[i].flag(flag)
+
+    if results_fp is not None:
+        save_quality_check_results(results, results_fp, land)
+
+
+# Bump this whenever a check in quality_check_flags() (and Observation.check_for_flags()) changes, so that results
+# kept by do_quality_check() are not reused.
+_quality_check_version = 1
+
+
+def _land_sha256(land) -> str:
+    """
+    :param land: A PreparedGeometry, LandMask or geometry, or None.
+    :return: The SHA-256 checksum of the land geometry, which identifies the land check, or "" if land is None.
+    """
+    if land is None:
+        return ""
+    elif isinstance(land, LandMask):
+        return land.geometry_sha256
+    else:
+        return hashlib.sha256(getattr(land, "context", land).wkb).hexdigest()
+
+
+def quality_check_hashes(columns: Dict[str, np.ndarray]) -> List[str]:
     """
-    for o in tqdm(range(len(obs)), desc="Performing quality check"):
-        obs[o].check_for_flags(land)
+    Gets a checksum of the properties of each observation that quality checking reads.  No other property can change
+    the flags that are raised.
+    :param columns: The properties, as extracted in do_quality_check().
+    :return: The hexadecimal checksum of each observation.
+    """
+    rows = zip(*(columns[name] for name in _qc_key_lists))
+    return [hashlib.blake2b(repr(row).encode("utf8"), digest_size=16).hexdigest() for row in rows]
 
 
-def find_all_values(obs: List[Observation], attribute: str, tqdm=tqdm) -> Dict[str, int]:
+def save_quality_check_results(results: Dict[str, Tuple[str, Tuple[str, ...]]], fp: str, land=None):
     """
-    Finds all possible values for a given attribute in the observations.
+    Saves the flags raised by quality checking.
+    :param results: For each observation ID, the checksum of the observation (see quality_check_hashes()) and the flags
+    raised on it by quality checking.
+    :param fp: The path to save to.
+    :param land: The land geometry that was used for quality checking, or None if land check was not performed.
+    """
+    ids = list(results)
+    savez_atomic(fp, _version=np.array(_quality_check_version), _land_sha256=np.array(_land_sha256(land)),
+                 ids=np.array(ids, dtype=str), hashes=np.array([results[i][0] for i in ids], dtype=str),
+                 flags=np.array([",".join(results[i][1]) for i in ids], dtype=str))
+
+
+def load_quality_check_results(fp: str, land=None) -> Dict[str, Tuple[str, Tuple[str, ...]]]:
+    """
+    Loads the flags raised by quality checking (see save_quality_check_results()).
+    :param fp: The path to load from.
+    :param land: The land geometry that will be used for quality checking, or None if land check will not be performed.
+    :return: For each observation ID, the checksum of the observation and the flags raised on it.  The dictionary is
+    empty if there is no file, or if its results came from different checks (an incompatible version of this code, or a
+    different land geometry).
+    """
+    if not isfile(fp):
+        return dict()
+
+    with np.load(fp) as results:
+        if int(results["_version"]) != _quality_check_version or str(results["_land_sha256"]) != _land_sha256(land):
+            return dict()
+        return {ob_id: (ob_hash, tuple(flags.split(",")) if flags else ())
+                for ob_id, ob_hash, flags in zip(results["ids"].tolist(), results["hashes"].tolist(),
+                                                 results["flags"].tolist())}
+
+
+# The keys read by the checks in quality_check_flags().  See Observation for the meaning of each.
+_obscuration_keys = ["Fog", "Smoke", "Haze", "VolcanicAsh", "Dust", "Sand", "Spray", "HeavyRain", "HeavySnow",
+                     "BlowingSnow"]
+_cloud_type_keys = ["Cirrus", "Cirrocumulus", "Cumulus", "Altocumulus", "Stratus", "Nimbostratus", "Altostratus",
+                    "Stratocumulus", "Cumulonimbus", "Cirrostratus"]
+_contrail_keys = ["ShortLivedContrails", "SpreadingContrails", "NonSpreadingContrails"]
+_tcc_categories = ["none", "clear", "few", "isolated", "scattered", "broken", "overcast", "obscured"]
+_larvae_categories = ["1-25", "26-50", "51-100", "more than 100"]
+
+# For each property read by the checks, the keys that it is found under, in order of preference.
+_qc_key_lists = dict(protocol=["protocol"], elevation=["elevation", "Observation Elevation"],
+                     date=["Measurment Date (UTC)", "Measurement Date (UTC)"],
+                     time=["Measurment Time (UTC)", "Measurement Time (UTC)"], MeasuredAt=["MeasuredAt"],
+                     lat=["Observation Latitude"], lon=["Observation Longitude"],
+                     tcc=["Total Cloud Cover", "CloudCover"], TreeHeightAvgM=["TreeHeightAvgM"],
+                     LarvaeCount=["LarvaeCount"])
+_qc_key_lists.update((key, [key]) for key in _obscuration_keys + _cloud_type_keys + _contrail_keys)
+
+
+def _key_columns(obs: List[Observation], key_lists: Dict[str, List[str]]) -> Dict[str, np.ndarray]:
+    """
+    Looks up the same keys in many observations.
     :param obs: The observations.
+    :param key_lists: For each column to produce, the keys to look for, in order of preference (see
+    Observation.try_keys()).
+    :return: For each column, an object array of the value of the first key that each observation has, or None if it
+    has none of them.
+    """
+    columns = {name: np.full(len(obs), None, dtype=object) for name in key_lists}
+
+    # Observations that share a key-resolution table are looked up together: the table is consulted once per key, and
+    # the values are then read straight from each observation's storage.  For CompactObservation, a key missing from
+    # the table is missing from the observation only if it is one of the kept keys (see observation.used_keys); other
+    # keys are packed away, so columns that ask for any of them are looked up the usual way.
+    groups = dict()
+    others = []
+    for i, ob in enumerate(obs):
+        if type(ob) is Observation:
+            store = ob._raw
+        elif type(ob) is CompactObservation and ob._extra is None:
+            store = ob._values
+        else:
+            others.append(i)
+            continue
+        table, prefix, positions, stores = groups.setdefault(id(ob._keys), (ob._keys, ob.key_prefix, [], []))
+        positions.append(i)
+        stores.append(store)
+
+    for table, prefix, positions, stores in groups.values():
+        positions = np.array(positions)
+        compact = type(obs[positions[0]]) is CompactObservation
+        for name, keys in key_lists.items():
+            if compact and any(CompactObservation._unprefixed(key, prefix) not in used_keys for key in keys):
+                columns[name][positions] = [obs[i].try_keys(keys) for i in positions]
+                continue
+            slot = next((table[key] for key in keys if key in table), None)
+            if slot is not None:
+                columns[name][positions] = [store[slot] for store in stores]
+
+    # Anything else (e.g. a CompactObservation with keys set after loading) is looked up the usual way.
+    for i in others:
+        for name, keys in key_lists.items():
+            columns[name][i] = obs[i].try_keys(keys)
+
+    return columns
+
+
+def _to_floats(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Converts values to floats the way float() does.
+    :param values: An object array of values.
+    :return: The floats (NaN where missing or invalid), whether each value is missing (None), and whether each value is
+    invalid (could not be converted).
+    """
+    missing = np.equal(values, None)
+    floats = np.full(len(values), np.nan)
+    invalid = np.zeros(len(values), dtype=bool)
+    present = np.flatnonzero(~missing)
+    try:
+        floats[present] = values[present].astype(np.float64)
+    except (TypeError, ValueError):
+        # At least one value is not a number; find out which one at a time.
+        for i in present:
+            try:
+                floats[i] = float(values[i])
+            except (TypeError, ValueError):
+                invalid[i] = True
+    return floats, missing, invalid
+
+
+def quality_check_flags(obs: List[Observation], land=None) -> Tuple[List[str], np.ndarray]:
+    """
+    Evaluates the checks of Observation.check_for_flags() over all the observations at once, without raising any flags.
+    :param obs: The observations.
+    :param land: The PreparedGeometry or LandMask for land checking.  If None, land check will not be performed.
+    :return: The flag codes, in the order in which check_for_flags() raises them, and a boolean array with one row per
+    observation and one column per flag code, True where the check raises that flag on that observation.  A code can
+    appear more than once, since more than one check can raise it.
+    """
+    return _quality_check_columns(_key_columns(obs, _qc_key_lists), land)
+
+
+def _quality_check_columns(columns: Dict[str, np.ndarray], land=None) -> Tuple[List[str], np.ndarray]:
+    """
+    Does the work of quality_check_flags(), given the properties it reads (see _qc_key_lists).
+    """
+    n = len(columns["protocol"])
+    checks = []
+    protocols = columns["protocol"]
+
+    # Elevation: EX, EI, ER.
+    elevation, missing, invalid = _to_floats(columns["elevation"])
+    checks += [("EX", missing), ("EI", invalid),
+               ("ER", ~missing & ~invalid & ~((elevation >= -300.) & (elevation <= 6000.)))]
+
+    # Datetime: DX, DI, DF, DO, DZ.
+    # As in Observation.measured_dt_string, separate date and time keys take precedence over MeasuredAt.
+    dts, dt_flags = parse_datetimes(m if d is None or t is None else "{}T{}".format(d, t)
+                                    for d, t, m in zip(columns["date"], columns["time"], columns["MeasuredAt"]))
+    valid = ~np.isnat(dts)
+    time_of_day = dts - dts.astype("datetime64[D]")
+    checks += [("DX", dt_flags == "DX"), ("DI", dt_flags == "DI"),
+               ("DF", valid & (dts > np.datetime64(datetime.now(), "us"))),
+               ("DO", valid & (dts < np.datetime64("1995-01-01"))),
+               ("DZ", valid & (time_of_day < np.timedelta64(1, "m")))]
+
+    # Location: LM, LI, LW, OP, LZ.  Latitude and longitude each raise LM or LI, so both are listed in turn.
+    lat, lat_missing, lat_invalid = _to_floats(columns["lat"])
+    lon, lon_missing, lon_invalid = _to_floats(columns["lon"])
+    located = ~(lat_missing | lat_invalid | lon_missing | lon_invalid)
+    over_water = np.zeros(n, dtype=bool)
+    sprayed = np.zeros(n, dtype=bool)
+    if land is not None:
+        over_water[located] = ~points_on_land(land, lon[located], lat[located])
+        sprayed = located & ~over_water & (columns["Spray"] == "true")
+    checks += [("LM", lat_missing), ("LI", lat_invalid), ("LM", lon_missing), ("LI", lon_invalid),
+               ("LW", over_water), ("OP", sprayed), ("LZ", located & (lat == 0.) & (lon == 0.)), ("LI", ~located)]
+
+    # Obscuration: OR, then (only when no obscurations are reported, as .tcc is not read otherwise) CM, CI and CX, then
+    # OX and OC.
+    sky = protocols == "sky_conditions"
+    num_obscurations = sum((columns[key] == "true").astype(int) for key in _obscuration_keys)
+    num_cloud_types = sum((columns[key] == "true").astype(int) for key in _cloud_type_keys)
+    tcc = columns["tcc"]
+    tcc_valid = np.logical_or.reduce([tcc == category for category in _tcc_categories])
+    tcc_read = sky & (num_obscurations == 0)
+    checks += [("OR", sky & (num_obscurations > 2)),
+               ("CM", tcc_read & (tcc == "-99")),
+               ("CI", tcc_read & ~np.equal(tcc, None) & ~tcc_valid & (tcc != "-99")),
+               ("CX", tcc_read & np.equal(tcc, None)),
+               ("OX", tcc_read & (tcc == "obscured")),
+               ("OC", sky & (num_obscurations > 0) & (num_cloud_types > 0))]
+
+    # Tree height: TX, TM, TR, TI.
+    trees = protocols == "tree_heights"
+    height, missing, invalid = _to_floats(columns["TreeHeightAvgM"])
+    coded_missing = ~missing & ~invalid & (height == -99.)
+    checks += [("TX", trees & missing), ("TM", trees & coded_missing),
+               ("TR", trees & ~missing & ~invalid & ~coded_missing & ~((height >= 0.) & (height <= 99.))),
+               ("TI", trees & invalid)]
+
+    # Mosquito larvae count: MR, MI.
+    mosquitoes = protocols == "mosquito_habitat_mapper"
+    larvae_values = columns["LarvaeCount"]
+    larvae, missing, invalid = _to_floats(larvae_values)
+    larvae_category = np.logical_or.reduce([larvae_values == category for category in _larvae_categories])
+    checks += [("MR", mosquitoes & ~missing & ~invalid & ~((larvae >= 0.) & (larvae <= 199.))),
+               ("MI", mosquitoes & invalid & ~larvae_category)]
+
+    # Contrail count: NI, NR.  Blank counts are ignored.
+    contrails = np.zeros(n)
+    contrails_invalid = np.zeros(n, dtype=bool)
+    for key in _contrail_keys:
+        values = columns[key].copy()
+        values[np.array([type(v) is str and v.strip() == "" for v in values], dtype=bool)] = None
+        count, missing, invalid = _to_floats(values)
+        contrails += np.where(missing | invalid, 0., count)
+        contrails_invalid |= invalid
+    checks += [("NI", contrails_invalid), ("NR", contrails >= 20)]
+
+    return [code for code, _ in checks], np.column_stack([mask for _, mask in checks])
+
+
+def find_all_values(obs: Union[List[Observation], ObservationTable], attribute: str, tqdm=tqdm) -> Dict[str, int]:
+    """
+    Finds all possible values for a given attribute in the observations.
+    :param obs: The observations, or an ObservationTable.  If attribute is one of the table's columns, the values are
+    counted from the column with np.unique (missing values, i.e. "", NaN or NaT, are not counted); otherwise they are
+    read from the observations.
     :param attribute: The attribute to find values for.
     :param tqdm: The wrapper around for-loops in this function.  Default tqdm, which will print a progress bar.
     :return: A dictionary of (value, count) pairs, each indicating that the given attribute had the value 'value' count
     times in the observations.  If an observation does not have a particular attribute, it contributes nothing to this
     returned dictionary.
     """
-    ret = dict()
+    if isinstance(obs, ObservationTable):
+        if attribute in obs.columns:
+            return _find_all_column_values(obs[attribute])
+        obs = obs.observations
+
+    # The keys read by this package can be looked up in bulk (see _key_columns()); any other key is looked up in each
+    # observation in turn.
+    if attribute in used_keys:
+        values = _key_columns(obs, {attribute: [attribute]})[attribute]
+    else:
+        values = (ob.soft_get(attribute) for ob in tqdm(obs, desc="Sifting observations"))
+    return dict(Counter(val for val in values if val is not None))
 
-    for ob in tqdm(obs, desc="Sifting observations"):
-        if attribute in ob:
-            val = ob[attribute]
-            try:
-                ret[val] += 1
-            except KeyError:
-                ret[val] = 1
 
-    return ret
+def _find_all_column_values(column: np.ndarray) -> Dict[Any, int]:
+    """
+    See find_all_values().
+    :param column: A column of an ObservationTable.
+    :return: A dictionary of (value, count) pairs for the values in the column, apart from missing values.
+    """
+    if column.dtype.kind in "US":
+        column = column[column != ""]
+    elif column.dtype.kind == "f":
+        column = column[~np.isnan(column)]
+    elif column.dtype.kind in "mM":
+        column = column[~np.isnat(column)]
+    values, counts = np.unique(column, return_counts=True)
+    return dict(zip(values.tolist(), counts.tolist()))
 
 
-def find_all_attributes(obs: List[dict], tqdm=tqdm) -> List[str]:
+def find_all_attributes(obs: Union[List[Observation], ObservationTable], tqdm=tqdm) -> List[str]:
     """
     Generates a sorted list of all attributes that occur at least once in the observations.
-    :param obs: The observations.
+    :param obs: The observations, or an ObservationTable.
     :param tqdm: The wrapper around for-loops in this function.  Default tqdm, which will print a progress bar.
     :return: A sorted list of all attributes that occur at least once in the observations.
     """
-    all_keys = []
+    if isinstance(obs, ObservationTable):
+        obs = obs.observations
+
+    all_keys = set()
+    # Observations that share a key-resolution table have exactly the keys in that table, so each table only needs to
+    # be read once.
+    seen_tables = set()
     for ob in tqdm(obs, desc="Sifting observations"):
-        for key in ob.keys:
-            if key not in all_keys:
-                all_keys.append(key)
+        if type(ob) is Observation:
+            if id(ob._keys) not in seen_tables:
+                seen_tables.add(id(ob._keys))
+                all_keys.update(ob._keys.values())
+        else:
+            all_keys.update(ob.keys)
 
     return sorted(all_keys)
 
@@ -508,12 +1785,48 @@ def bin_cloud_fraction(fraction: float, clip: bool = False) -> str:
             return k
 
 
-def filter_by_datetime(obs: List[Observation], earliest: Optional[datetime] = datetime.min,
+def _datetime_range_mask(table: ObservationTable, earliest: Optional[datetime],
+                         latest: Optional[datetime]) -> np.ndarray:
+    """
+    :return: Whether each observation in the table has a measurement datetime in [earliest, latest).  None means the
+    range is unbounded on that side.  Observations without a datetime are never in the range.
+    """
+    dts = table["measured_dt"]
+    keep = ~np.isnat(dts)
+    if earliest is not None:
+        keep &= dts >= np.datetime64(earliest, "us")
+    if latest is not None:
+        keep &= dts < np.datetime64(latest, "us")
+    return keep
+
+
+def time_index(obs: Union[List[Observation], ObservationTable]) -> TimeIndex:
+    """
+    Builds a TimeIndex of the observations, which lets filter_by_datetime(), filter_by_hour() and
+    filter_by_datetime_cdf() find the observations that pass by binary search instead of looking at every observation.
+    Build it once per set of observations and reuse it for as many ranges as needed.
+    :param obs: The observations, or an ObservationTable.  For a list, the datetimes are parsed as by
+    measured_datetimes(), which raises flags DX and DI where appropriate.
+    :return: The index.
+    """
+    return TimeIndex(obs["measured_dt"] if isinstance(obs, ObservationTable) else measured_datetimes(obs))
+
+
+def _check_time_index(obs: Union[List[Observation], ObservationTable], index: TimeIndex):
+    """
+    :raises ValueError: If the index was not built from as many observations as there are in obs.
+    """
+    if len(index) != len(obs):
+        raise ValueError("Argument 'index' must be built from the same observations as argument 'obs'.")
+
+
+def filter_by_datetime(obs: Union[List[Observation], ObservationTable], earliest: Optional[datetime] = datetime.min,
                        latest: Optional[datetime] = datetime.max, assume_chronology: bool = False,
-                       tqdm=tqdm) -> List[Observation]:
+                       tqdm=tqdm, index: Optional[TimeIndex] = None) -> Union[List[Observation], ObservationTable]:
     """
     Filters a list of observations to a certain datetime range, assuming chronology of the observations.
-    :param obs: The observations.
+    :param obs: The observations, or an ObservationTable (in which case a table is returned, and assume_chronology is
+    ignored).
     :param earliest: The earliest datetime that an observation may have to pass the filter.  Default datetime.min, which
     filters out no observations.
     :param latest: The earliest datetime that an observation may have to NOT pass the filter - that is, observations
@@ -521,8 +1834,10 @@ def filter_by_datetime(obs: List[Observation], earliest: Optional[datetime] = da
     :param assume_chronology: Whether the observations are in ascending chronological order.  If set to True when the
     observations are NOT in strictly chronological order, arbitrary returns will result.  Default False.
     :param tqdm: The wrapper around for-loops in this function.  Default tqdm, which will print a progress bar.
-    :return: The observations that passed the filter.
-    :raises ValueError: If earliest is after latest.
+    :param index: The TimeIndex of the observations, if already built (see time_index()).  Default None.  If given,
+    assume_chronology is ignored, and observations without a datetime never pass.
+    :return: The observations that passed the filter, in their original order.
+    :raises ValueError: If earliest is after latest, or index was built from different observations.
     """
     if earliest is not None and latest is not None and (earliest >= latest):
         raise ValueError("Argument 'earliest' must not be after argument 'latest'.")
@@ -530,9 +1845,18 @@ def filter_by_datetime(obs: List[Observation], earliest: Optional[datetime] = da
     elif earliest is None and latest is None:
         return obs
 
+    if index is not None:
+        _check_time_index(obs, index)
+        return _select(obs, index.between(earliest, latest))
+
+    if isinstance(obs, ObservationTable):
+        return obs.where(_datetime_range_mask(obs, earliest, latest))
+
     if assume_chronology:
         first_acceptable_index = 0
         if earliest is not None:
+            # If no observation is late enough, none are acceptable.
+            first_acceptable_index = len(obs)
             for o in tqdm(range(len(obs)), desc="Cutting for early date"):
                 if obs[o].measured_dt >= earliest:
                     first_acceptable_index = o
@@ -540,7 +1864,7 @@ def filter_by_datetime(obs: List[Observation], earliest: Optional[datetime] = da
 
         last_acceptable_index = None
         if latest is not None:
-            for o in tqdm(range(len(obs[first_acceptable_index:])), desc="Cutting for late date"):
+            for o in tqdm(range(first_acceptable_index, len(obs)), desc="Cutting for late date"):
                 if obs[o].measured_dt >= latest:
                     last_acceptable_index = o
                     break
@@ -556,24 +1880,120 @@ def filter_by_datetime(obs: List[Observation], earliest: Optional[datetime] = da
         return ret
 
 
-def filter_by_hour(obs: List[Observation], hours: List[int]) -> List[Observation]:
+def spatial_index(obs: Union[List[Observation], ObservationTable], cell_size: float = 1.0) -> SpatialIndex:
+    """
+    Builds a SpatialIndex of the observations, which lets filter_by_bbox(), filter_by_radius() and
+    nearest_observations() look only at the observations near the place in question.  Build it once per set of
+    observations and reuse it for as many queries as needed.
+    :param obs: The observations, or an ObservationTable.  For a list, each observation's lat and lon are read, which
+    raises flags LM and LI where appropriate.
+    :param cell_size: The size of each cell of the index, in degrees.  Default 1.0.
+    :return: The index.
+    """
+    if isinstance(obs, ObservationTable):
+        return SpatialIndex(obs["lat"], obs["lon"], cell_size)
+    lat = np.array([np.nan if ob.lat is None else ob.lat for ob in obs], dtype=np.float64)
+    lon = np.array([np.nan if ob.lon is None else ob.lon for ob in obs], dtype=np.float64)
+    return SpatialIndex(lat, lon, cell_size)
+
+
+def _check_spatial_index(obs: Union[List[Observation], ObservationTable],
+                         index: Optional[SpatialIndex]) -> SpatialIndex:
+    """
+    :return: The index, or a new one for obs if index is None.
+    :raises ValueError: If the index was not built from as many observations as there are in obs.
+    """
+    if index is None:
+        return spatial_index(obs)
+    if len(index) != len(obs):
+        raise ValueError("Argument 'index' must be built from the same observations as argument 'obs'.")
+    return index
+
+
+def filter_by_bbox(obs: Union[List[Observation], ObservationTable], south: float, west: float, north: float,
+                   east: float, index: Optional[SpatialIndex] = None) -> Union[List[Observation], ObservationTable]:
+    """
+    Filters observations to those within a box of latitude and longitude, edges included.
+    :param obs: The observations, or an ObservationTable (in which case a table is returned).
+    :param south: The southernmost latitude.
+    :param west: The westernmost longitude.  If west is greater than east, the box crosses the antimeridian.
+    :param north: The northernmost latitude.
+    :param east: The easternmost longitude.
+    :param index: The SpatialIndex of the observations, if already built (see spatial_index()).  Default None, which
+    builds one.
+    :return: The observations that passed the filter, in their original order.
+    :raises ValueError: If south is greater than north, or index was built from different observations.
+    """
+    return _select(obs, _check_spatial_index(obs, index).in_bbox(south, west, north, east))
+
+
+def filter_by_radius(obs: Union[List[Observation], ObservationTable], lat: float, lon: float, radius: float,
+                     index: Optional[SpatialIndex] = None) -> Union[List[Observation], ObservationTable]:
+    """
+    Filters observations to those within a distance of a point, along the surface of the Earth.
+    :param obs: The observations, or an ObservationTable (in which case a table is returned).
+    :param lat: The latitude of the point.
+    :param lon: The longitude of the point.
+    :param radius: The distance, in km.
+    :param index: The SpatialIndex of the observations, if already built (see spatial_index()).  Default None, which
+    builds one.
+    :return: The observations that passed the filter, in their original order.
+    :raises ValueError: If radius is negative, or index was built from different observations.
+    """
+    return _select(obs, _check_spatial_index(obs, index).within(lat, lon, radius))
+
+
+def nearest_observations(obs: Union[List[Observation], ObservationTable], lat: float, lon: float, k: int = 1,
+                         index: Optional[SpatialIndex] = None) -> Tuple[Union[List[Observation], ObservationTable],
+                                                                         np.ndarray]:
+    """
+    Finds the observations nearest to a point, along the surface of the Earth.
+    :param obs: The observations, or an ObservationTable (in which case a table is returned).
+    :param lat: The latitude of the point.
+    :param lon: The longitude of the point.
+    :param k: The number of observations to find.  Default 1.
+    :param index: The SpatialIndex of the observations, if already built (see spatial_index()).  Default None, which
+    builds one.
+    :return: The k nearest observations (fewer if fewer have a valid location), nearest first, and their distances from
+    the point in km.
+    :raises ValueError: If k is less than 1, or index was built from different observations.
+    """
+    positions, distances = _check_spatial_index(obs, index).nearest(lat, lon, k)
+    return _select(obs, positions), distances
+
+
+def filter_by_hour(obs: Union[List[Observation], ObservationTable], hours: List[int],
+                   index: Optional[TimeIndex] = None) -> Union[List[Observation], ObservationTable]:
     """
     Filters a list of observations by the hour of measurement.
-    :param obs: The observations.
+    :param obs: The observations, or an ObservationTable (in which case a table is returned).
     :param hours: The hours that shall pass the filter.
+    :param index: The TimeIndex of the observations, if already built (see time_index()).  Default None.
     :return: The observations that passed the filter.
+    :raises ValueError: If index was built from different observations.
     """
+    if index is not None:
+        _check_time_index(obs, index)
+        return _select(obs, index.at_hours(hours))
+
+    if isinstance(obs, ObservationTable):
+        dts = obs["measured_dt"]
+        hour_of_day = (dts.astype("datetime64[h]") - dts.astype("datetime64[D]")).astype(np.int64)
+        return obs.where(~np.isnat(dts) & np.isin(hour_of_day, list(hours)))
+
     return [ob for ob in obs if ob.measured_dt.hour in hours]
 
 
 def process_one_day(download_folder: str = "", download_file: str = "SC_LC_MHM_TH__%S.json",
-                    day: Optional[Union[date, datetime]] = None):
+                    day: Optional[Union[date, datetime]] = None, results_fp: Optional[str] = None):
     """
     Downloads, parses, and quality-checks one day's observations.
     :param download_folder: The folder to download the JSON file to.  Default "" (current working directory).
     :param download_file: The name that the JSON file should have.  Certain % codes are replaced; see
     download_from_api().  Default "SC_LC_MHM_TH__%S.json" (%S replaced by the date).
     :param day: The day to process.  Default None, which is treated as yesterday.
+    :param results_fp: The path to a file of quality-check results kept between runs (see do_quality_check()).
+    Default None, in which case every observation is checked.
     :return: The list of observations.
     :raises ValueError: If the JSON file contains no observations.
     """
@@ -592,7 +2012,7 @@ def process_one_day(download_folder: str = "", download_file: str = "SC_LC_MHM_T
 
     # Perform quality checking.
     land = prepare_earth_geometry()
-    do_quality_check(observations, land)
+    do_quality_check(observations, land, results_fp=results_fp)
 
     # Summarize flags.
     flag_summary = get_flag_counts(observations)
@@ -601,54 +2021,127 @@ def process_one_day(download_folder: str = "", download_file: str = "SC_LC_MHM_T
     return observations
 
 
-def filter_by_datetime_cdf(obs: List[Observation], cdf: Dataset, buffer: timedelta):
+def filter_by_datetime_cdf(obs: Union[List[Observation], ObservationTable], cdf: Dataset, buffer: timedelta,
+                           index: Optional[TimeIndex] = None):
     """
     Filters a list of observations, returning only those which lie within the time span of the CDF with the given
     buffer.
-    :param obs: A list of observations.
+    :param obs: A list of observations, or an ObservationTable (in which case a table is returned).
     :param cdf: A NetCDF4 Dataset.
     :param buffer: The amount of time on either side of the Dataset's begin and end time in which observation will still
     pass the filter.  For instance, if buffer is 30 minutes, then observations will pass if they are between
     (CDF begin datetime - 30 minutes) and (CDF end datetime + 30 minutes).
+    :param index: The TimeIndex of the observations, if already built (see time_index()).  Default None.
     :return:
+    :raises ValueError: If index was built from different observations.
     """
     earliest = get_cdf_datetime(cdf, 0) - buffer
     latest = get_cdf_datetime(cdf, -1) + buffer
+    if index is not None:
+        _check_time_index(obs, index)
+        return _select(obs, index.between(earliest, latest))
+    if isinstance(obs, ObservationTable):
+        return obs.where(_datetime_range_mask(obs, earliest, latest))
     return [ob for ob in obs if earliest <= ob.measured_dt < latest]
 
 
+def id_index(obs: List[Observation]) -> Dict[Any, List[int]]:
+    """
+    Indexes observations by their ID or number (see Observation.id), e.g. to apply several patches with
+    patch_obs_columns().  The index does not change if the observations do, so it must be rebuilt after observations are
+    added or removed.
+    :param obs: The observations.
+    :return: A dictionary from each ID to the positions of the observations with that ID, in ascending order.
+    Observations without an ID are left out.
+    """
+    index = dict()
+    ids = _key_columns(obs, {"id": ["ObservationId", "Observation Number"]})["id"]
+    for i, ob_id in enumerate(ids):
+        if ob_id is not None:
+            try:
+                index[ob_id].append(i)
+            except KeyError:
+                index[ob_id] = [i]
+    return index
+
+
+def patch_obs_columns(obs: List[Observation], fp: str, attributes: Optional[List[str]] = None,
+                      processors: Optional[Dict[str, Callable[[str], Any]]] = None,
+                      index: Optional[Dict[Any, List[int]]] = None, tqdm=tqdm) -> int:
+    """
+    Applies a patch of several attributes to the observations at once.  The patch is a CSV file whose first column is
+    either the observation ID or number (whichever is present in the obs), and whose other columns are the values of
+    the attributes for that observation.  Rows with the wrong number of columns, or with a value that a processor
+    rejects with a ValueError, are skipped.
+    :param obs: The observations to patch.
+    :param fp: The path to the patch file.
+    :param attributes: The attributes to store the values of the second, third, etc. columns to.  Default None, in which
+    case the first row of the file is a header naming them (its first column is ignored).
+    :param processors: For each attribute that needs it, the function used to process incoming values; i.e., float or
+    int (as otherwise all values are strings).  Default None, which performs no processing.
+    :param index: The positions of the observations by ID, if already known (see id_index()).  Default None, which
+    builds it.
+    :param tqdm: The wrapper around for-loops in this function.  Default tqdm, which will print a progress bar.
+    :return: The number of observations patched.  Observations are modified in-place, and their memoized properties are
+    recomputed on next access (see Observation.invalidate_cache()).  If the following patch file is used:
+        id,foo,bar
+        299023,1,a
+        928302,2,b
+    then the observation with id 299023 will have ["foo"] == "1" and ["bar"] == "a", and the observation with id 928302
+    will have ["foo"] == "2" and ["bar"] == "b".
+    :raises ValueError: If the file has no header and attributes is None.
+    """
+    if index is None:
+        index = id_index(obs)
+    processors = processors or dict()
+
+    patched = 0
+    with open(fp, "r", newline="") as f:
+        rows = csv.reader(f)
+        if attributes is None:
+            header = next(rows, None)
+            if header is None:
+                raise ValueError("The patch file at '{}' has no header, so argument 'attributes' must be given."
+                                 .format(fp))
+            attributes = [h.strip() for h in header[1:]]
+        process = [processors.get(attribute, None) for attribute in attributes]
+
+        # Each row is joined to its observations through the index and all of its values are set at once.
+        for row in tqdm(rows, desc="Applying patch"):
+            if len(row) != len(attributes) + 1 or row[0] not in index:
+                continue
+            try:
+                values = {attribute: val if p is None else p(val)
+                          for attribute, p, val in zip(attributes, process, row[1:])}
+            except ValueError:
+                continue
+            for i in index[row[0]]:
+                obs[i].update(values)
+                patched += 1
+
+    return patched
+
+
 def patch_obs(obs: List[Observation], fp: str, attribute: str, processor: Callable[[str], Any] = lambda v: v,
               tqdm=tqdm):
     """
     Applies a patch to the observations.  The patch is a CSV file whose first column is either to observation ID or
-    number (whichever is present in the obs), and the second column is the value associated with that observation.
+    number (whichever is present in the obs), and the second column is the value associated with that observation.  See
+    patch_obs_columns() to apply several attributes at once.
     :param obs: The observations to patch.
     :param fp: The path to the patch file.
     :param attribute: The attribute to store the value to for each observation.
     :param processor: The function used to process incoming values; i.e., float or int (as otherwise all values are
     strings).  Default lambda v: v, which performs no processing.
     :param tqdm: The wrapper around for-loops in this function.  Default tqdm, which will print a progress bar.
-    :return: None.  Observations are modified in-place.  If the following patch file is used:
+    :return: None.  Observations are modified in-place, and their memoized properties are recomputed on next access
+    (see Observation.invalidate_cache()).  If the following patch file is used:
         299023,foo
         928302,bar
     and attribute is "poo", then the observation with id 299023 will have ["poo"] == "foo" and the observation with id
     928302 will have ["poo"] == "bar".
     """
-    patch = dict()
-    with open(fp, "r") as f:
-        for line in tqdm(f, desc="Reading patch"):
-            try:
-                ob_id, val = line.split(",")
-                patch[ob_id] = processor(val[:-1])
-            except ValueError:
-                pass
-        f.close()
-
-    for ob in tqdm(obs, desc="Applying patch"):
-        try:
-            ob[attribute] = patch[ob.id]
-        except KeyError:
-            pass
+    patch_obs_columns(obs, fp, attributes=[attribute], processors={attribute: processor}, tqdm=tqdm)
 
 
 def pretty_print_observation(ob: Observation, **kwargs):
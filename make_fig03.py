@@ -61,7 +61,7 @@ def mainfig03():
     # For each of those sources...
     for a in range(4):
         # Get the observations that have that protocol.
-        obs_from_protocol = [ob for ob in obs if ob["protocol"] == protocols[a]]
+        obs_from_protocol = groups.select(protocol=protocols[a], DataSource=go_app)
        
         # Plot
         artists.append(plotters.plot_ob_scatter(obs_from_protocol, ax, s=40, marker=markers[a], color=colors[a]))
@@ -98,7 +98,7 @@ def mainfig03():
         artists = []
     
         # Get the observations that have that protocol.
-        obs_from_protocol = [ob for ob in obs if ob["protocol"] == protocols[a]]
+        obs_from_protocol = groups.select(protocol=protocols[a], DataSource=go_app)
         
         # Plot
         artists.append(plotters.plot_ob_scatter(obs_from_protocol, ax, s=40, 
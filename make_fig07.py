@@ -41,33 +41,37 @@ def mainfig07():
     #obs = globeobs
     
     # Total number of observations per protocol
+    # - obs is grouped here, rather than using groups from data_common, so that
+    #   switching obs to globeobs above still works
+    obs_by_protocol = tools.partition(obs, keys=["protocol"])
     num_obs_pro = np.empty(len(protocols))
     for k in range(len(protocols)):
-        num_obs_pro[k] = len([ob for ob in obs if ob["protocol"] == protocols[k]])
+        num_obs_pro[k] = obs_by_protocol.count(protocol=protocols[k])
         
     # Print stats for the paper    
     print('---+ Number of GO obs per protocol = ', num_obs_pro) # 
 
-    # Do QC, to include land geometry detection.
-    tools.do_quality_check(obs, tools.prepare_earth_geometry())
+    # Do QC, to include land geometry detection.  The land mask gives the same
+    # answers as the Earth geometry, but only tests points near a coastline.
+    tools.do_quality_check(obs, tools.prepare_land_mask())
+
+    # The flags of every observation, as one bitmask each.  These are worked
+    # out once here and shared by both of the tallies below.
+    masks = tools.flag_masks(obs)
 
     # This dictionary is {'flag code': count}, where
     # - 'flag code' is a 2-3 letter abbreviation for given quality flag
     # - count is the total number of incidences of that quality flag 
-    flags = tools.get_flag_counts(obs)
+    flags = tools.get_flag_counts(obs, masks=masks)
 
     # This dictionary will be {'flag code': {'protocol: count}} - i.e., it is 
     # a dictionary of dictionaries. 
     # Example: {'LW': {'GLOBE Observer App': 26}}
+    # The counts for every flag and protocol are tallied in one pass.
+    flag_codes, (protocol_names,), counts = tools.crosstab_flags(obs, by=["protocol"], masks=masks)
     flags2 = dict()
-
-    # For each flag...
-    for flag in flags:
-        # Filter to only the obs which have this flag
-        obsFlagged = tools.filter_by_flag_sets(obs, all_of=[flag])
-    
-        # Set the flags2 entry to the dictionary of source=count pairs
-        flags2[flag] = tools.find_all_values(obsFlagged, "protocol")# debugging
+    for flag, row in zip(flag_codes, counts):
+        flags2[flag] = {name: int(count) for name, count in zip(protocol_names, row) if count > 0}
 
     # Pretty print counts by flag and protocol   
     print(' ')    
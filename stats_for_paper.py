@@ -43,7 +43,7 @@ def mainstats():
     # - Number of GLOBE Observer observations per protocol computed in make_fig06.py
     num_globeobs_pro = np.empty(len(protocols))
     for k in range(len(protocols)):
-        num_globeobs_pro[k] = len([ob for ob in globeobs if ob["protocol"] == protocols[k]])
+        num_globeobs_pro[k] = groups.count(protocol=protocols[k], DataSource=lambda source: source != go_app)
          
     #--------------------------------------------------------------------------
     # Photo stats
@@ -129,7 +129,12 @@ def mainstats():
     MyData['Userid'] = [int(i['Userid']) for i in obs]
 
     # extract dates and add them to the data frame
-    MyData['ObsDate'] = [dt.datetime.strptime(i['MeasuredAt'],"%Y-%m-%dT%H:%M:%S") for i in obs]
+    # - parsed all at once; missing or malformed dates become NaT, and those
+    #   observations are dropped, since they cannot be placed on any day
+    # - like reading ob.measured_dt, this raises the DX (missing) and DI
+    #   (invalid) flags on those observations in obs
+    MyData['ObsDate'] = tools.measured_datetimes(obs)
+    MyData = MyData.dropna(subset=['ObsDate'])
     
     # Start and end dates of the 2019 Fall GLOBE Clouds Challenge
     EventDateStart = dt.datetime(2019,10,15)